@@ -0,0 +1,189 @@
+import os
+import shutil
+import sqlite3
+import string
+import time
+from typing import Optional
+
+# hex digest length -> hashlib algorithm
+hash_algorithms = {
+    32: 'md5',
+    40: 'sha1',
+    64: 'sha256',
+}
+
+default_algorithm = 'sha256'
+
+
+def hash_algorithm(digest: str) -> Optional[str]:
+    """Get hashlib algorithm name by hex digest, None if value is not a known digest"""
+    if digest and all(char in string.hexdigits for char in digest):
+        return hash_algorithms.get(len(digest))
+
+
+class AssetStore:
+
+    """ Content-addressed asset storage
+
+        Every unique content is stored once as <root>/<hex digest>,
+        asset files in type directories are hardlinks to stored content
+        (copies when filesystem does not support hardlinks).
+    """
+
+    incoming_dir = 'incoming'
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def path(self, digest: str) -> str:
+        return os.path.join(self.root, digest.lower())
+
+    def has(self, digest: str) -> bool:
+        return os.path.isfile(self.path(digest))
+
+    def incoming(self, name: str) -> str:
+        """Path for content being downloaded"""
+        path = os.path.join(self.root, self.incoming_dir)
+        os.makedirs(path, exist_ok=True)
+        return os.path.join(path, name)
+
+    def add(self, source: str, digest: str) -> str:
+        """Move verified file to storage, return digest
+
+           already stored content is kept, so existing links stay deduplicated
+        """
+        os.makedirs(self.root, exist_ok=True)
+        try:
+            os.link(source, self.path(digest))
+            os.remove(source)
+        except FileExistsError:
+            os.remove(source)
+        except OSError:
+            os.replace(source, self.path(digest))
+        return digest.lower()
+
+    def link(self, digest: str, local_path: str) -> str:
+        """Link stored content to asset path, replacing existing file"""
+        if os.path.exists(local_path) and os.path.samefile(self.path(digest), local_path):
+            return local_path
+        temp_path = f"{local_path}.link"
+        try:
+            os.link(self.path(digest), temp_path)
+        except FileExistsError:
+            os.remove(temp_path)
+            return self.link(digest, local_path)
+        except OSError:
+            # no hardlinks on filesystem (vfat, shared folders)
+            shutil.copyfile(self.path(digest), temp_path)
+        os.replace(temp_path, local_path)
+        return local_path
+
+    def sweep(self) -> int:
+        """Remove stored content not linked to any asset path, return number of bytes freed"""
+        freed = 0
+        if not os.path.isdir(self.root):
+            return freed
+        for entry in os.scandir(self.root):
+            if entry.is_file(follow_symlinks=False):
+                stat = entry.stat()
+                if stat.st_nlink == 1:
+                    os.remove(entry.path)
+                    freed += stat.st_size
+        return freed
+
+    def __str__(self):
+        return f"AssetStore <{self.root}>"
+
+
+class AssetManifest:
+
+    """ Persistent index of loaded assets
+
+        Asset is considered loaded while its local file has the same size
+        and modification time as when it was recorded.
+        Last use time is kept for disk quota eviction,
+        evicted assets stay recorded and are not loaded again until used.
+    """
+
+    timeout = 5
+
+    def __init__(self, path: str):
+        self.path = path
+        db = self.connect()
+        try:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('CREATE TABLE IF NOT EXISTS assets ('
+                       'hash TEXT PRIMARY KEY, local_path TEXT NOT NULL, size INTEGER NOT NULL, '
+                       'mtime INTEGER NOT NULL, verified INTEGER NOT NULL DEFAULT 0, '
+                       'last_used REAL NOT NULL DEFAULT 0, evicted INTEGER NOT NULL DEFAULT 0)')
+        finally:
+            db.close()
+
+    def connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=self.timeout)
+
+    def add(self, _hash: str, local_path: str, verified: bool = False):
+        """Record loaded asset file"""
+        stat = os.stat(local_path)
+        db = self.connect()
+        try:
+            with db:
+                db.execute('INSERT OR REPLACE INTO assets (hash, local_path, size, mtime, verified, last_used) '
+                           'VALUES (?, ?, ?, ?, ?, ?)',
+                           (_hash, local_path, stat.st_size, stat.st_mtime_ns, verified, time.time()))
+        finally:
+            db.close()
+
+    def touch(self, _hash: str):
+        """Update last use time of asset, evicted asset is loaded again on next sync"""
+        db = self.connect()
+        try:
+            with db:
+                db.execute('UPDATE assets SET last_used = ?, evicted = 0 WHERE hash = ?', (time.time(), _hash))
+        finally:
+            db.close()
+
+    def evict(self, *hashes: str):
+        """Mark assets removed over disk quota"""
+        db = self.connect()
+        try:
+            with db:
+                db.executemany('UPDATE assets SET evicted = 1 WHERE hash = ?', [(_hash,) for _hash in hashes])
+        finally:
+            db.close()
+
+    def remove(self, *hashes: str):
+        db = self.connect()
+        try:
+            with db:
+                db.executemany('DELETE FROM assets WHERE hash = ?', [(_hash,) for _hash in hashes])
+        finally:
+            db.close()
+
+    def entries(self) -> dict:
+        """Get all records by asset hash"""
+        db = self.connect()
+        db.row_factory = sqlite3.Row
+        try:
+            return {row['hash']: dict(row) for row in db.execute('SELECT * FROM assets')}
+        finally:
+            db.close()
+
+    @staticmethod
+    def is_intact(entry: dict, local_path: str) -> bool:
+        """Check recorded file is still in place and unchanged"""
+        if not entry or entry['local_path'] != local_path:
+            return False
+        try:
+            stat = os.stat(local_path)
+        except OSError:
+            return False
+        return stat.st_size == entry['size'] and stat.st_mtime_ns == entry['mtime']
+
+    @staticmethod
+    def is_evicted(entry: dict, local_path: str) -> bool:
+        """Check recorded file was removed over disk quota"""
+        return bool(entry and entry['evicted'] and entry['local_path'] == local_path)
+
+    def __str__(self):
+        return f"AssetManifest <{self.path}>"
@@ -1,20 +1,23 @@
 import asyncio
 import collections.abc
 import concurrent.futures
+import hashlib
 import logging
 import logging.handlers
 import multiprocessing as mp
 import os
 import shutil
-from typing import Any, List, TextIO, Union
-
-import yaml
-
-from skabenclient.helpers import FileLock, get_ip, get_mac
-from skabenclient.loaders import HTTPLoader, get_yaml_loader
+import threading
+import time
+from typing import Any, Iterable, List, Optional, TextIO, Union
+
+from skabenclient.assets import AssetManifest, AssetStore, default_algorithm, hash_algorithm
+# FileLock is re-exported for existing imports from config
+from skabenclient.helpers import FileLock, SharedState, get_ip, get_mac, make_event  # noqa: F401
+from skabenclient.loaders import BandwidthLimiter, HTTPLoader
 from skabenclient.logger import CoreLogger
+from skabenclient.storage import Storage, YAMLStorage, get_storage, read_errors, yaml_load
 
-ExtendedLoader = get_yaml_loader()
 _mapping = collections.abc.Mapping
 
 
@@ -22,7 +25,8 @@ class Config:
 
     """ Abstract config class
 
-        Provides methods for reading and writing .yml config file with filelock
+        Provides methods for reading and writing config file,
+        .yml with filelock by default, see skabenclient.storage for other backends
     """
 
     # essential config
@@ -35,40 +39,37 @@ class Config:
         "NESTED"
     ]
 
+    storage_class = YAMLStorage
+
     def __init__(self, config_path: str):
         self.data = dict()
         self.config_path = config_path
         if not config_path:
             raise Exception(f'config path is missing for {self}')
+        self.storage = self.make_storage()
         current = self.read()
         self.update(current)
 
+    def make_storage(self) -> Storage:
+        return self.storage_class(self.config_path)
+
     def _yaml_load(self, target: TextIO) -> dict:
         """Loads yaml from given file"""
-        result = yaml.load(target, Loader=ExtendedLoader)
-        if not result:
-            raise EOFError(f"{target} cannot be loaded")
-        return result
+        return yaml_load(target)
 
     def read(self):
-        """ Reads from config file """
+        """ Reads from config storage """
         try:
-            with FileLock(self.config_path):
-                with open(self.config_path, 'r') as fh:
-                    return self._yaml_load(fh)
+            return self.storage.read()
         except Exception:
             raise
 
-    def write(self, data: dict = None, mode: str = 'w'):
-        """ Writes to config file """
+    def write(self, data: dict = None, mode: str = 'w', keys: Iterable[str] = None):
+        """ Writes to config storage, only changed keys if storage supports it """
         if not data:
             data = self.data
         try:
-            data = self._filter(data)
-            with FileLock(self.config_path):
-                with open(self.config_path, mode) as fh:
-                    dump = yaml.dump(self._filter(data), default_flow_style=False)
-                    fh.write(dump)
+            self.storage.write(self._filter(data), keys=keys, mode=mode)
         except Exception:
             raise
 
@@ -150,6 +151,7 @@ class SystemConfig(Config):
             'q_int': mp.Queue(),
             'q_ext': mp.Queue(),
             'q_log': mp.Queue(),
+            'shared_state': SharedState(),
             'pub': _publish,
             'sub': _subscribe,
         })
@@ -180,13 +182,28 @@ class DeviceConfig(Config):
 
     """
         Device configuration, read-write
+
+        In write-behind mode saves are applied in memory, changed keys are marked
+        dirty and written to file once per write_behind seconds, on reload and on exit.
+
+        Storage backend other than yaml is selected by name, existing .yml config
+        is migrated to the new storage when it is empty.
     """
 
     minimal_essential_conf = {}
+    write_behind = 0  # seconds to coalesce saves, 0 writes on every save
 
-    def __init__(self, config_path: str):
+    def __init__(self, config_path: str, write_behind: float = None, backend: str = None):
         self.data = dict()
         self.not_stored_keys.extend(['message'])
+        if write_behind is not None:
+            self.write_behind = write_behind
+        self.backend = backend
+        self.dirty = set()
+        self.rewrite = False  # whole config should be written on flush
+        self.flush_stats = {"saves": 0, "flushes": 0}
+        self._lock = threading.RLock()
+        self._flush_timer = None
         super().__init__(config_path)
 
     def write_default(self):
@@ -195,8 +212,11 @@ class DeviceConfig(Config):
             raise RuntimeError('minimal essential conf values is missing, '
                                'config file cannot be reset to defaults')
         try:
-            self.data = self.minimal_essential_conf
-            self.write()
+            with self._lock:
+                self.data = self.minimal_essential_conf
+                self.write()
+                self.dirty.clear()
+                self.rewrite = False
             return self.data
         except PermissionError as e:
             raise PermissionError(f'config file write permission error: {e}')
@@ -210,7 +230,7 @@ class DeviceConfig(Config):
             if not set(self.minimal_essential_conf.keys()).issubset(set(config.keys())):
                 # check failed, essential keys missing
                 raise AttributeError
-        except (EOFError, FileNotFoundError, yaml.YAMLError, AttributeError):
+        except (*read_errors, AttributeError):
             # file is empty or not created or corrupted, rewrite with default conf
             config = self.write_default()
         except Exception:
@@ -219,6 +239,7 @@ class DeviceConfig(Config):
 
     def load(self):
         """ Load and apply state from file """
+        self.flush()
         try:
             current_conf = self.read()
             if not current_conf:
@@ -226,15 +247,67 @@ class DeviceConfig(Config):
             for k in self.minimal_essential_conf:
                 if k not in current_conf:
                     raise Exception('config inconsistency')
-            return self.update(self.read())
+            return self.update(current_conf)
         except Exception:
             return self.write_default()
 
+    def update(self, payload: dict) -> dict:
+        with self._lock:
+            return super().update(payload)
+
     def save(self, payload: dict = None):
         """ Apply and save persistent state """
-        if payload:
-            self.update(payload)
-        self.write(self.data)
+        with self._lock:
+            if payload:
+                self.update(payload)
+                self.dirty.update(k for k in payload if k not in self.not_stored_keys)
+            if not payload or payload.get("FORCE"):
+                self.rewrite = True
+            self.flush_stats["saves"] += 1
+            if not self.write_behind:
+                return self.flush()
+            if not self._flush_timer:
+                self._flush_timer = threading.Timer(self.write_behind, self.flush)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+
+    def flush(self):
+        """ Write pending changes to file """
+        with self._lock:
+            if self._flush_timer:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+            if not self.dirty and not self.rewrite:
+                return
+            self.write(self.data, keys=None if self.rewrite else set(self.dirty))
+            self.dirty.clear()
+            self.rewrite = False
+            self.flush_stats["flushes"] += 1
+
+    def make_storage(self) -> Storage:
+        storage = super().make_storage()
+        if self.backend:
+            storage = self._migrate(storage, get_storage(self.backend, self.config_path))
+        return storage
+
+    def use_backend(self, name: str) -> Storage:
+        """ Switch config storage backend by name """
+        with self._lock:
+            self.flush()
+            self.backend = name
+            self.storage = self._migrate(self.storage, get_storage(name, self.config_path))
+            return self.storage
+
+    def _migrate(self, source: Storage, target: Storage) -> Storage:
+        """ Copy config to target storage if target is empty """
+        if target.path == source.path or target.exists() or not source.exists():
+            return target
+        try:
+            current = source.read()
+        except read_errors:
+            return target
+        target.write(self._filter(current))
+        return target
 
     def current(self):
         """ Get current config """
@@ -250,6 +323,9 @@ class DeviceConfigExtended(DeviceConfig):
 
     asset_paths = {}  # directory paths by file types
     files_local = {}
+    download_report = {}  # results of last download by file hash
+    gc_report = {}  # results of last garbage collection
+    sync_report_interval = 10  # seconds between sync progress reports
 
     def __init__(self, config_path: str, system_config: SystemConfig):
         self.system = system_config
@@ -261,7 +337,13 @@ class DeviceConfigExtended(DeviceConfig):
         self.asset_root = os.path.join(self.system.root, asset_root)
         if not os.path.exists(self.asset_root):
             os.mkdir(self.asset_root)
-        super().__init__(config_path)
+        self.store = AssetStore(os.path.join(self.asset_root, self.system.get('asset_store', '.store')))
+        self.manifest = AssetManifest(os.path.join(self.asset_root,
+                                                   self.system.get('asset_manifest', 'manifest.sqlite')))
+        self._assets_lock = threading.Lock()  # asset files are not collected while linked
+        self._sync_lock = threading.Lock()
+        self.sync = {"files": 0, "started": time.monotonic(), "reported": None, "transfers": {}}
+        super().__init__(config_path, backend=self.system.get('config_backend'))
 
     def make_asset_paths(self, asset_dirs: Union[list, bool] = None) -> dict:
         self._update_paths(asset_dirs)
@@ -287,57 +369,226 @@ class DeviceConfigExtended(DeviceConfig):
             return self.asset_paths
 
     def parse_files(self, files: dict) -> dict:
+        """Get assets to be loaded
+
+           server file list is compared with loaded files in one pass and applied to config
+           with single update, assets recorded in manifest with unchanged local files
+           are not loaded again, nor assets evicted over disk quota until they are used,
+           assets missing in server list are removed
+           (their files are left for garbage collection)
+        """
         if not self.asset_paths:
             raise Exception("asset directories was not created, run DeviceConfig.make_asset_paths(asset_dirs) first!")
         not_loaded = {}
         if files and isinstance(files, dict):
             assets = self.get('assets', {})
+            manifest = None
+            restored = {}
 
             for _hash, url in files.items():
-                exists = assets.get(_hash)
-                if exists and self.files_local.get(_hash):
+                if self.files_local.get(_hash) and assets.get(_hash):
                     continue
 
-                file_type, orig_name = url.split("/")[-2:]
-                if len(orig_name.split(".")) < 2:
-                    raise NotImplementedError("URI without file extension not supported")
-
-                local_dir = self.asset_paths.get(file_type)
-                if not local_dir:
-                    raise Exception(f"no local directory was created for `{file_type}` type of files")
-
-                not_loaded.update({
-                    _hash: {
-                        "local_path": os.path.join(local_dir, orig_name),
-                        "hash": _hash,
-                        "url": url,
-                        "file_type": file_type,
-                    }
-                })
-                self.update({"assets": not_loaded, "NESTED": True})
+                asset = self._asset_record(_hash, url)
+                if manifest is None:
+                    manifest = self.manifest.entries()
+                entry = manifest.get(_hash)
+                if self.manifest.is_intact(entry, asset["local_path"]):
+                    self.set_file_loaded(_hash)
+                    restored[_hash] = asset
+                elif self.manifest.is_evicted(entry, asset["local_path"]):
+                    if _hash not in assets:
+                        restored[_hash] = asset
+                else:
+                    not_loaded[_hash] = asset
+
+            self._apply_assets(files, assets, {**restored, **not_loaded})
         return not_loaded
 
+    def _apply_assets(self, files: dict, assets: dict, changed: dict):
+        """Update assets with single config update, remove assets missing in server list"""
+        removed = [_hash for _hash in assets if _hash not in files]
+        for _hash in removed:
+            self.files_local.pop(_hash, None)
+        if removed:
+            kept = {_hash: asset for _hash, asset in assets.items() if _hash in files}
+            self.update({"assets": {**kept, **changed}})
+        elif changed:
+            self.update({"assets": changed, "NESTED": True})
+
+    def _asset_record(self, _hash: str, url: str) -> dict:
+        file_type, orig_name = url.split("/")[-2:]
+        if len(orig_name.split(".")) < 2:
+            raise NotImplementedError("URI without file extension not supported")
+
+        local_dir = self.asset_paths.get(file_type)
+        if not local_dir:
+            raise Exception(f"no local directory was created for `{file_type}` type of files")
+
+        return {
+            "local_path": os.path.join(local_dir, orig_name),
+            "hash": _hash,
+            "url": url,
+            "file_type": file_type,
+        }
+
+    def fetch_file(self, file_data: dict, limiter: BandwidthLimiter = None) -> dict:
+        """Download single asset to content store and link it to local path, raise on failure
+
+           asset hash is verified when it is md5, sha1 or sha256 hex digest,
+           content already in store or not modified on server is linked without download
+        """
+        _hash = file_data["hash"]
+        algorithm = hash_algorithm(_hash)
+        with self._assets_lock:
+            if algorithm and self.store.has(_hash):
+                return self._link_asset(_hash, _hash, file_data["local_path"], algorithm)
+        loaded, digest = self.fetch_verified(file_data, algorithm, limiter)
+        with self._assets_lock:
+            if loaded != file_data["local_path"] or not self.store.has(digest):
+                self.store.add(loaded, digest)
+            return self._link_asset(_hash, digest, file_data["local_path"], algorithm)
+
+    def _link_asset(self, _hash: str, digest: str, local_path: str, algorithm: str = None) -> dict:
+        path = self.store.link(digest, local_path)
+        self.manifest.add(_hash, path, verified=bool(algorithm))
+        self.set_file_loaded(_hash)
+        return {_hash: path}
+
+    def fetch_verified(self, file_data: dict, algorithm: str = None, limiter: BandwidthLimiter = None) -> tuple:
+        """Download asset to incoming directory of store, return file path and content digest
+
+           request is conditional on existing asset file, which is returned when not modified,
+           corrupted file is removed and loaded again up to `verify_retries` times
+        """
+        incoming = self.store.incoming(file_data["hash"])
+        attempts = self.system.get("verify_retries", 2) + 1
+        with HTTPLoader(self.system) as loader:
+            for attempt in range(1, attempts + 1):
+                loaded, digest = self.fetch_resumed(loader, file_data, incoming, algorithm, limiter)
+                if not algorithm or digest == file_data["hash"].lower():
+                    return loaded, digest
+                loader.file_cache.discard(file_data["local_path"])
+                if loaded == incoming:
+                    os.remove(incoming)
+                self.logger.warning(f'{file_data["url"]} hash mismatch: {digest}, attempt {attempt} of {attempts}')
+        raise Exception(f'{file_data["url"]} content does not match hash {file_data["hash"]}')
+
+    def fetch_resumed(self, loader: HTTPLoader, file_data: dict, incoming: str, algorithm: str = None,
+                      limiter: BandwidthLimiter = None) -> tuple:
+        """Load asset file, return file path and content digest
+
+           interrupted transfer is resumed from partial file up to `resume_retries` times
+        """
+        part_path = f"{incoming}{loader.part_suffix}"
+        retries = self.system.get("resume_retries", 2)
+        for retry in range(retries + 1):
+            hasher = hashlib.new(algorithm or default_algorithm)
+            try:
+                loaded = loader.get_file(file_data["url"], incoming, limiter=limiter, hasher=hasher,
+                                         current=file_data["local_path"])
+                return loaded, hasher.hexdigest()
+            except Exception as e:
+                if retry == retries or not os.path.isfile(part_path):
+                    raise
+                self.logger.warning(f'{e}, resuming from partial file')
+            finally:
+                self.record_transfer(file_data["hash"], loader.transfer)
+
     def get_file(self, file_data: dict) -> dict:
         try:
-            with HTTPLoader(self.system) as loader:
-                path = loader.get_file(file_data["url"], file_data["local_path"])
-                if path:
-                    self.set_file_loaded(file_data["hash"])
-                    return {file_data["hash"]: path}
+            return self.fetch_file(file_data)
         except Exception as e:
             self.logger.exception(f'while loading file: {e}')
 
     async def download(self, files: List[dict]) -> dict:
-        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.system.get("max_workers", 3))
-        loop = asyncio.get_event_loop()
-        for item in files:
-            await loop.run_in_executor(executor, self.get_file, item)
+        """Download files concurrently, up to `max_workers` transfers at once
+
+           total throughput is limited by `max_bandwidth` (bytes per second) when set,
+           per-file results and transfer metrics are stored to download_report
+        """
+        with self._sync_lock:
+            self.sync = {"files": len(files), "started": time.monotonic(), "reported": None, "transfers": {}}
+        max_bandwidth = self.system.get("max_bandwidth")
+        limiter = BandwidthLimiter(max_bandwidth) if max_bandwidth else None
+        loop = asyncio.get_running_loop()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.system.get("max_workers", 3)) as executor:
+            transfers = [loop.run_in_executor(executor, self.fetch_file, item, limiter) for item in files]
+            results = await asyncio.gather(*transfers, return_exceptions=True)
+
+        self.download_report = {"loaded": {}, "failed": {}}
+        for item, result in zip(files, results):
+            if isinstance(result, Exception):
+                self.logger.error(f'while loading file {item["url"]}: {result}')
+                self.download_report["failed"][item["hash"]] = str(result)
+            else:
+                self.download_report["loaded"].update(result)
+        self.download_report.update(transfers=self.sync["transfers"], summary=self.sync_summary())
+        self.send_sync_report(final=True)
+        if self.system.get("asset_gc"):
+            self.collect_garbage_async()
         return self.data["assets"]
 
+    def record_transfer(self, _hash: str, transfer: dict):
+        """Add single transfer to asset metrics, repeated transfer of asset is counted as retry"""
+        with self._sync_lock:
+            metrics = self.sync["transfers"].setdefault(_hash, {"bytes": 0, "duration": 0, "retries": 0,
+                                                                "attempts": 0})
+            metrics["retries"] += transfer.get("retries", 0) + (1 if metrics["attempts"] else 0)
+            metrics["attempts"] += 1
+            metrics["bytes"] += transfer.get("bytes", 0)
+            metrics["duration"] += transfer.get("duration", 0)
+            metrics["throughput"] = metrics["bytes"] / metrics["duration"] if metrics["duration"] else 0
+        self.send_sync_report()
+
+    def sync_summary(self) -> dict:
+        """Aggregated metrics of current or last sync"""
+        with self._sync_lock:
+            transfers = list(self.sync["transfers"].values())
+            elapsed = time.monotonic() - self.sync["started"]
+            total = sum(metrics["bytes"] for metrics in transfers)
+            return {
+                "files": self.sync["files"],
+                "transferred": len(transfers),
+                "bytes": total,
+                "elapsed": round(elapsed, 3),
+                "throughput": round(total / elapsed) if elapsed else 0,
+                "retries": sum(metrics["retries"] for metrics in transfers),
+            }
+
+    def send_sync_report(self, final: bool = False):
+        """Send sync progress to server as INFO packet when `sync_report` enabled
+
+           progress is sent at most once per `sync_report_interval` seconds, final report is always sent
+        """
+        if not self.system.get("sync_report"):
+            return
+        now = time.monotonic()
+        interval = self.system.get("sync_report_interval", self.sync_report_interval)
+        with self._sync_lock:
+            reported = self.sync["reported"]
+            if not final and reported is not None and now - reported < interval:
+                return
+            self.sync["reported"] = now
+        report = self.sync_summary()
+        if final:
+            report["failed"] = len(self.download_report.get("failed", {}))
+        report["final"] = final
+        self.system.get("q_int").put(make_event("device", "info", {"sync_report": report}))
+
     def get_files_async(self, files: List[dict]):
         loop = asyncio.new_event_loop()
         asyncio.set_event_loop(loop)
-        return loop.run_until_complete(self.download(files))
+        try:
+            return loop.run_until_complete(self.download(files))
+        finally:
+            loop.close()
+
+    def http_stats(self) -> dict:
+        """New and reused connections of shared HTTP session, validator cache hits and misses"""
+        loader = HTTPLoader(self.system)
+        return {**loader.connection_stats(), "cache": loader.cache_stats(),
+                "file_cache": loader.cache_stats(loader.file_cache)}
 
     def get_files_sync(self, files: List[dict]):
         for item in files:
@@ -347,6 +598,107 @@ class DeviceConfigExtended(DeviceConfig):
     def set_file_loaded(self, _hash: str):
         self.files_local[_hash] = _hash
 
+    def mark_asset_used(self, _hash: str):
+        """Record asset use for disk quota eviction
+
+           not called by library: device calls it when asset is played or shown,
+           asset evicted over quota is loaded again on next sync after use
+        """
+        self.manifest.touch(_hash)
+
+    def collect_garbage(self, quota: int = None) -> dict:
+        """Remove loaded files not referenced in assets, evict least recently used assets over quota
+
+           assets are the last server file list applied by `parse_files`,
+           files in asset directories not recorded in manifest are removed as untracked,
+           quota in bytes is taken from `asset_quota` system config when not provided,
+           evicted assets are not loaded again until marked used by `mark_asset_used`
+        """
+        quota = quota if quota is not None else self.system.get("asset_quota")
+        report = {"orphaned": [], "evicted": [], "untracked": [], "freed": 0}
+
+        with self._assets_lock:
+            entries = self.manifest.entries()
+            kept = self._collect_orphans(entries, report)
+            if quota:
+                self._collect_quota(kept, quota, report)
+            kept_paths = {entry["local_path"] for _hash, entry in kept.items() if _hash not in report["evicted"]}
+            self._remove_assets(entries, kept_paths, report)
+            self._sweep_untracked(kept_paths, report)
+            report["freed"] += self.store.sweep()
+
+        self.gc_report = report
+        self.logger.info(f'asset gc: {len(report["orphaned"])} orphaned, {len(report["evicted"])} evicted, '
+                         f'{len(report["untracked"])} untracked, {report["freed"]} bytes freed')
+        return report
+
+    def _collect_orphans(self, entries: dict, report: dict) -> dict:
+        """Report manifest entries not referenced in assets, return loaded entries"""
+        assets = self.get("assets", {})
+        kept = {}
+        for _hash, entry in entries.items():
+            asset = assets.get(_hash)
+            if not asset or asset.get("local_path") != entry["local_path"]:
+                report["orphaned"].append(_hash)
+            elif not entry["evicted"]:
+                kept[_hash] = entry
+        return kept
+
+    def _collect_quota(self, kept: dict, quota: int, report: dict):
+        """Report least recently used entries to evict until disk usage fits quota"""
+        # files linked to same content are counted once
+        inodes = {_hash: self._inode(entry["local_path"]) for _hash, entry in kept.items()}
+        links = collections.Counter(inodes.values())
+        usage = sum({inodes[_hash]: entry["size"] for _hash, entry in kept.items() if inodes[_hash]}.values())
+        for _hash, entry in sorted(kept.items(), key=lambda item: item[1]["last_used"]):
+            if usage <= quota:
+                break
+            links[inodes[_hash]] -= 1
+            if inodes[_hash] and not links[inodes[_hash]]:
+                usage -= entry["size"]
+            report["evicted"].append(_hash)
+
+    def _remove_assets(self, entries: dict, kept_paths: set, report: dict):
+        """Remove files of orphaned and evicted entries, forget orphaned and mark evicted in manifest"""
+        for _hash in report["orphaned"] + report["evicted"]:
+            local_path = entries[_hash]["local_path"]
+            self.files_local.pop(_hash, None)
+            if local_path in kept_paths:
+                continue
+            try:
+                stat = os.stat(local_path)
+                os.remove(local_path)
+                report["freed"] += stat.st_size if stat.st_nlink == 1 else 0
+            except FileNotFoundError:
+                pass
+        self.manifest.remove(*report["orphaned"])
+        self.manifest.evict(*report["evicted"])
+
+    def _sweep_untracked(self, kept_paths: set, report: dict):
+        """Remove files in asset directories not recorded in manifest"""
+        for local_dir in filter(os.path.isdir, self.asset_paths.values()):
+            for entry in os.scandir(local_dir):
+                if not entry.is_file(follow_symlinks=False) or entry.path in kept_paths:
+                    continue
+                stat = entry.stat()
+                os.remove(entry.path)
+                report["untracked"].append(entry.path)
+                report["freed"] += stat.st_size if stat.st_nlink == 1 else 0
+
+    @staticmethod
+    def _inode(path: str) -> Optional[tuple]:
+        try:
+            stat = os.stat(path)
+            return stat.st_dev, stat.st_ino
+        except OSError:
+            return
+
+    def collect_garbage_async(self, quota: int = None) -> threading.Thread:
+        """Run garbage collection in background thread"""
+        thread = threading.Thread(target=self.collect_garbage, args=(quota,), name="asset-gc", daemon=True)
+        thread.start()
+        return thread
+
     def get_json(self, url: str) -> dict:
         with HTTPLoader(self.system) as loader:
             response = loader.get_json(url)
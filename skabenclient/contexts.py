@@ -1,19 +1,25 @@
 import os
 import random
 import time
+from functools import partial
+from multiprocessing import Pipe, connection
+from queue import Empty
 from threading import Thread
 from typing import Union
 
 import packets as sp
 
 from skabenclient.config import SystemConfig
-from skabenclient.helpers import Event, make_event
+from skabenclient.helpers import Event, TimestampStore, make_event
 
 
 class BaseContext:
     """
        Context base class
        (separated timestamp management and helper functions)
+
+       context is long-lived: config keys, device identity and timestamp are
+       resolved once on creation and kept in memory between events
     """
 
     event = dict()
@@ -31,12 +37,9 @@ class BaseContext:
 
         # keepalive TS management
         self.timestamp_fname = os.path.join(self.config.root, 'timestamp')
-        if not os.path.exists(self.timestamp_fname):
-            with open(self.timestamp_fname, 'w') as fh:
-                fh.write('0')
-
-        self.timestamp = self.get_last_timestamp()
-        self.task_id = ''.join([str(random.randrange(10)) for _ in range(10)])
+        self.timestamps = TimestampStore(self.timestamp_fname,
+                                         self.config.get('timestamp_flush_interval', 10))
+        self.task_id = self.make_task_id()
 
         # for event context topic is always pub
         self.topic = self.config.get('pub')
@@ -44,23 +47,28 @@ class BaseContext:
         self.device = self.config.get('device')
         if not self.device:
             raise Exception(f'{self} error: device not provided')
+        self.packets = sp.PacketFactory(self.topic, self.uid,
+                                        codec=self.config.get('packet_codec'),
+                                        compression=self.config.get('packet_compression'),
+                                        compress_threshold=self.config.get('compress_threshold'))
+        # timestamp and config hash for PONG replies from MQTT process
+        self.shared = self.config.get('shared_state')
+
+    @staticmethod
+    def make_task_id() -> str:
+        return ''.join([str(random.randrange(10)) for _ in range(10)])
+
+    @property
+    def timestamp(self) -> int:
+        return self.timestamps.value
 
     def get_last_timestamp(self):
         """Read previous timestamp value from timestamp file"""
-        with open(self.timestamp_fname, 'r') as fh:
-            t = fh.read().rstrip()
-            try:
-                return int(t)
-            except Exception:
-                t = 0
-                self.rewrite_timestamp(t)
-                return t
+        return self.timestamps.load()
 
     def rewrite_timestamp(self, new_ts: Union[str, int]) -> int:
-        """Write timestamp value to file"""
-        with open(self.timestamp_fname, 'w') as fh:
-            fh.write(str(int(new_ts)))
-            return int(new_ts)
+        """Update timestamp value, write to file is deferred"""
+        return self.timestamps.set(new_ts)
 
     def get_current_config(self):
         """load current device config
@@ -81,27 +89,51 @@ class BaseContext:
         if packet_type not in ('ack', 'nack'):
             raise Exception(f'packet type not ACK or NACK: {packet_type}')
 
+        self.q_ext.put(self.packets.confirm(packet_type, task_id, self.timestamp, self.config_hash))
         packet_class = getattr(sp, packet_type.upper())
-        packet = packet_class(topic=self.config.get('pub'),
-                              timestamp=self.timestamp,
-                              uid=self.config.get('uid'),
-                              task_id=task_id,
-                              config_hash=self.config_hash)
-        self.q_ext.put(packet.encode())
-        return packet
+        return packet_class(topic=self.topic,
+                            timestamp=self.timestamp,
+                            uid=self.uid,
+                            task_id=task_id,
+                            config_hash=self.config_hash)
 
-    def __enter__(self):
+    def share_state(self):
+        if self.shared:
+            self.shared.update(self.timestamp, self.config_hash or '')
+
+    def open(self):
+        """Start context lifecycle"""
+        self.share_state()
         return self
 
+    def close(self):
+        """Finish context lifecycle, persist pending state"""
+        self.device.flush()
+        self.timestamps.close()
+
+    def __enter__(self):
+        return self.open()
+
     def __exit__(self, *err):
-        return
+        self.close()
 
 
 class EventContext(BaseContext):
 
     filtered_keys = ['id', 'uid']
 
+    def __init__(self, app_config: SystemConfig):
+        super().__init__(app_config)
+        # MQTT command -> handler, resolved once per context
+        self.mqtt_handlers = {
+            'ping': self.send_pong,
+            'cup': partial(self.mqtt_to_internal, internal_command='update'),
+            'sup': partial(self.mqtt_to_internal, internal_command='sup'),
+            'info': partial(self.mqtt_to_internal, internal_command='info'),
+        }
+
     def absorb(self, event: Event):
+        self.task_id = self.make_task_id()
         try:
             if event.type == "mqtt":
                 self.manage_mqtt(event)
@@ -110,6 +142,8 @@ class EventContext(BaseContext):
         except Exception:
             # TODO: send message to q_ext on fail
             raise
+        finally:
+            self.share_state()
 
     def manage(self, event: Event):
         """Managing events based on type"""
@@ -182,27 +216,22 @@ class EventContext(BaseContext):
         self.rewrite_timestamp(timestamp)
 
         try:
-            if command == 'ping':
-                pong = self.make_pong_reply()
-                self.q_ext.put(pong)
-            elif command == 'cup':
-                self.mqtt_to_internal(event, 'update')
-            elif command == 'sup':
-                self.mqtt_to_internal(event, 'sup')
-            elif command == 'info':
-                self.mqtt_to_internal(event, 'info')
-            else:
+            handler = self.mqtt_handlers.get(command)
+            if not handler:
                 raise Exception(f"unrecognized command: {command}")
+            handler(event)
         except Exception as e:
             raise Exception(f"[E] MQTT context: {e}")
 
+    def send_pong(self, event: Event):
+        if event.data.get('replied'):
+            # already answered by MQTT process, only timestamp is updated
+            return
+        self.q_ext.put(self.make_pong_reply())
+
     def make_pong_reply(self):
         # reply with pong immediately
-        packet = sp.PONG(topic=self.topic,
-                         uid=self.uid,
-                         timestamp=self.timestamp,
-                         config_hash=self.config_hash)
-        return packet.encode()
+        return self.packets.pong(self.timestamp, self.config_hash)
 
     def mqtt_to_internal(self, mqtt_event: Event, internal_command: str):
         datahold = mqtt_event.data.get('datahold')
@@ -213,11 +242,7 @@ class EventContext(BaseContext):
 
     def send_message(self, data: dict):
         """INFO packet"""
-        packet = sp.INFO(topic=self.topic,
-                         uid=self.uid,
-                         timestamp=self.timestamp,
-                         datahold=data)
-        self.q_ext.put(packet.encode())
+        self.q_ext.put(self.packets.datahold('info', data, self.timestamp))
 
     def send_config(self, data: dict = None):
         """SUP packet"""
@@ -229,12 +254,7 @@ class EventContext(BaseContext):
 
             data = {k: v for k, v in data.items() if k not in self.filtered_keys}
             # send update to server
-            packet = sp.SUP(topic=self.topic,
-                            uid=self.uid,
-                            task_id=self.task_id,
-                            timestamp=self.timestamp,
-                            datahold=data)
-            self.q_ext.put(packet.encode())
+            self.q_ext.put(self.packets.datahold('sup', data, self.timestamp, self.task_id))
         except Exception as e:
             raise Exception(f"[E] config send - {e} \n {self}")
 
@@ -246,13 +266,7 @@ class EventContext(BaseContext):
         else:
             datahold = {'request': 'all'}  # full conf
 
-        packet = sp.CUP(topic=self.topic,
-                        uid=self.uid,
-                        timestamp=self.timestamp,
-                        task_id=self.task_id,
-                        datahold=datahold,
-                        config_hash=self.config_hash)
-        self.q_ext.put(packet.encode())
+        self.q_ext.put(self.packets.datahold('cup', datahold, self.timestamp, self.task_id, self.config_hash))
 
     def save_config_and_report(self, event: Event):
         """ACK/NACK packet"""
@@ -280,54 +294,158 @@ class Router(Thread):
        external queue used only for sending messages to server via MQTT
        new mqtt messages from server comes to internal queue from MQTTClient
        queues separated because of server messages top priority
+
+       router blocks on internal and logging queues at once and wakes up only
+       when one of them has something to handle or when it is stopped
+
+       consecutive device input events arriving within input_coalesce_window
+       seconds are merged into one event (last value wins for every key)
     """
 
     managed_events = ["exit", "device", "mqtt"]
+    idle_timeout = None  # wait for queues until woken up
 
     def __init__(self, config: SystemConfig):
         super().__init__()
         self.daemon = True
-        self.running = False
+        # stopping router interrupts waiting for queues
+        self._wakeup, self._wakeup_signal = Pipe(duplex=False)
+        self._running = False
         self.queue_int = config.get("q_int")
         self.queue_ext = config.get("q_ext")
         self.queue_log = config.get("q_log")
         self.logger = config.logger_instance
-        # passing to contexts
+        # passing to context
         self.config = config
+        self.context = None
+        self.coalesce_window = config.get("input_coalesce_window", 0)
+        self.input_stats = {"received": 0, "merged": 0, "dispatched": 0}
+
+    @property
+    def running(self) -> bool:
+        return self._running
+
+    @running.setter
+    def running(self, value: bool):
+        self._running = value
+        if not value:
+            self.wakeup()
+
+    def wakeup(self):
+        """Interrupt waiting for queues"""
+        self._wakeup_signal.send_bytes(b'')
+
+    def wait_queues(self, timeout: float = None) -> list:
+        """Block until internal or logging queue becomes readable or router is woken up, return ready queues"""
+        readers = {self.queue_int._reader: self.queue_int,
+                   self.queue_log._reader: self.queue_log,
+                   self._wakeup: None}
+        ready = connection.wait(list(readers), timeout)
+        while self._wakeup.poll():
+            self._wakeup.recv_bytes()
+        return [readers[reader] for reader in ready if readers[reader] is not None]
+
+    def handle_logs(self):
+        """Pass all pending log records to root logger"""
+        while True:
+            try:
+                log_record = self.queue_log.get_nowait()
+            except Empty:
+                return
+            self.logger.handle(log_record)
+
+    @staticmethod
+    def is_input(event: Event) -> bool:
+        return event.type == "device" and event.cmd == "input" and isinstance(event.data, dict)
+
+    def coalesce(self, event: Event) -> list:
+        """Merge input event with following input events within coalesce window
+
+           returns events to route in order, first non-input event stops merging
+        """
+        if not self.is_input(event):
+            return [event]
+
+        self.input_stats["received"] += 1
+        self.input_stats["dispatched"] += 1
+        if not self.coalesce_window:
+            return [event]
+
+        merged = make_event(event.type, event.cmd, dict(event.data))
+        deadline = time.monotonic() + self.coalesce_window
+        while True:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                return [merged]
+            try:
+                following = self.queue_int.get(timeout=timeout)
+            except Empty:
+                return [merged]
+            if not self.is_input(following):
+                return [merged, following]
+            merged.data.update(following.data)
+            self.input_stats["received"] += 1
+            self.input_stats["merged"] += 1
+
+    def route(self, event: Event):
+        """Route single event from internal queue"""
+        if event.type not in self.managed_events:
+            raise Exception(f"cannot determine message type for:\n{event}")
+        elif event.type == "exit":
+            self.queue_ext.put(event)
+            return self.stop()
+
+        self.context.absorb(event)
 
     def run(self):
         """Routing events from internal queue"""
         self.logger.debug('router module starting...')
         self.running = True
 
+        try:
+            # single context serves all events during router lifetime
+            self.context = EventContext(self.config).open()
+        except Exception:
+            self.logger.exception("[!] cannot create event context")
+            self.running = False
+            return
+
+        try:
+            self.loop()
+        finally:
+            self.close_context()
+
+    def close_context(self):
+        """Persist pending context state, context is closed once"""
+        context, self.context = self.context, None
+        if context:
+            context.close()
+
+    def loop(self):
+        """Wait for queues and dispatch events until stopped"""
         while self.running:
-            if not self.queue_log.empty():
-                log_record = self.queue_log.get()
-                self.logger.handle(log_record)
+            ready = self.wait_queues(self.idle_timeout)
+            if not self.running:
+                return
+
+            if self.queue_log in ready:
+                self.handle_logs()
 
-            if self.queue_int.empty():
-                time.sleep(.1)
+            if self.queue_int not in ready:
                 continue
 
             # get event from internal queue
-            try:
-                event = self.queue_int.get()
-
-                if event.type not in self.managed_events:
-                    raise Exception(f"cannot determine message type for:\n{event}")
-                elif event.type == "exit":
-                    self.queue_ext.put(event)
-                    return self.stop()
-
-                with EventContext(self.config) as context:
-                    context.absorb(event)
-            except Exception:
-                self.logger.exception("[!]")
+            for event in self.coalesce(self.queue_int.get()):
+                try:
+                    self.route(event)
+                except Exception:
+                    self.logger.exception("[!]")
 
     def stop(self):
         """Full stop"""
         self.logger.info('router module stopping...')
         print('Router exiting gracefully...')
+        self.close_context()
         exit_message = ("exit", "exit")
         self.queue_ext.put(exit_message)
         time.sleep(1)
@@ -21,6 +21,12 @@ class BaseDevice:
         self.logger = app_config.logger()
         # assign device ingame config
         self.config = device_config
+        write_behind = app_config.get('config_write_behind')
+        if write_behind is not None:
+            self.config.write_behind = write_behind
+        backend = app_config.get('config_backend')
+        if backend:
+            self.config.use_backend(backend)
         self.config.load()  # load and update current running conf
 
     def run(self):
@@ -93,5 +99,8 @@ class BaseDevice:
     def load(self):
         return self.config.load()
 
+    def flush(self):
+        return self.config.flush()
+
     def __str__(self):
         return f"Basic Device <{self.system}>"
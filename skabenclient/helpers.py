@@ -1,10 +1,14 @@
 import fcntl
 import logging
+import multiprocessing as mp
 import os
 import socket
 import struct
 import subprocess
+import tempfile
+import threading
 import time
+from typing import Optional, Tuple, Union
 
 import yaml
 
@@ -57,6 +61,112 @@ def get_config(file_name: str) -> dict:
             raise
 
 
+def atomic_write(path: str, content: Union[str, bytes]):
+    """Write file via temporary file and rename, file is never left half-written"""
+    mode = 'wb' if isinstance(content, bytes) else 'w'
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+                                    prefix=f'.{os.path.basename(path)}.')
+    try:
+        with os.fdopen(fd, mode) as fh:
+            fh.write(content)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+class SharedState:
+    """Timestamp and config hash shared between processes
+
+       written by event context after every event, used by MQTT process
+       to reply PING without passing it through router
+    """
+
+    hash_size = 64
+
+    def __init__(self):
+        self.lock = mp.Lock()
+        self._timestamp = mp.RawValue('q', 0)
+        self._config_hash = mp.RawArray('c', self.hash_size)
+
+    def update(self, timestamp: int = None, config_hash: Optional[str] = None):
+        with self.lock:
+            if timestamp is not None:
+                self._timestamp.value = int(timestamp)
+            if config_hash is not None:
+                self._config_hash.value = str(config_hash).encode('utf-8')[:self.hash_size]
+
+    def snapshot(self) -> Tuple[int, Optional[str]]:
+        with self.lock:
+            return self._timestamp.value, self._config_hash.value.decode('utf-8') or None
+
+    def advance(self, timestamp: int) -> bool:
+        """Move timestamp forward, return False for timestamp from the past"""
+        with self.lock:
+            if timestamp < self._timestamp.value:
+                return False
+            self._timestamp.value = timestamp
+            return True
+
+
+class TimestampStore:
+    """Keepalive timestamp storage
+
+       value kept in memory, writes to file are coalesced within flush interval
+       and performed atomically. Zero interval means write on every change.
+    """
+
+    def __init__(self, path: str, flush_interval: float = 0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.dirty = False
+        self.writes = 0
+        self._lock = threading.Lock()
+        self._timer = None
+        self.value = self.load()
+
+    def load(self) -> int:
+        """Read timestamp from file, 0 if file is missing or corrupted"""
+        try:
+            with open(self.path, 'r') as fh:
+                return int(fh.read().strip())
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def set(self, value: Union[str, int]) -> int:
+        """Update timestamp value and schedule write"""
+        value = int(value)
+        with self._lock:
+            if value == self.value and not self.dirty:
+                return value
+            self.value = value
+            self.dirty = True
+            if self.flush_interval and not self._timer:
+                self._timer = threading.Timer(self.flush_interval, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        if not self.flush_interval:
+            self.flush()
+        return value
+
+    def flush(self):
+        """Write pending value to file"""
+        with self._lock:
+            if self._timer:
+                self._timer.cancel()
+                self._timer = None
+            if not self.dirty:
+                return
+            atomic_write(self.path, str(self.value))
+            self.dirty = False
+            self.writes += 1
+
+    def close(self):
+        self.flush()
+
+
 class Event:
     """Internal queue event"""
 
@@ -79,39 +189,57 @@ def make_event(_type, cmd: str = None, data: dict = None) -> Event:
 
 
 class FileLock:
-    """Locking file
+    """Advisory file lock (flock) on `<file>.lock`
 
-       TODO: should use fcntl.flock
+       shared lock for readers, exclusive lock for writers.
+       free lock is acquired immediately, busy lock is waited for in blocking flock
+       without timeout (None) or retried until timeout - flock itself has no timeout
     """
 
     locked = None
+    retry_interval = .005
 
-    def __init__(self, file_to_lock: str, timeout=1):
+    def __init__(self, file_to_lock: str, timeout=1, shared: bool = False):
         self.timeout = timeout
+        self.shared = shared
         self.lock_path = os.path.abspath(file_to_lock) + '.lock'
+        self.fd = None
 
     def acquire(self):
         """Acquire file lock"""
-        idx = 0
-        while not self.locked:
+        if self.locked:
+            return self.locked
+        operation = fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX
+        fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if self.timeout is None:
+                fcntl.flock(fd, operation)
+            else:
+                self._retry(fd, operation)
+        except BaseException:
+            os.close(fd)
+            raise
+        self.fd = fd
+        self.locked = True
+        return self.locked
+
+    def _retry(self, fd: int, operation: int):
+        """Retry non-blocking flock until timeout"""
+        deadline = time.monotonic() + self.timeout
+        while True:
             try:
-                time.sleep(.1)
-                with open(self.lock_path, 'w+') as fl:
-                    content = fl.read().strip()
-                    if content != '1':
-                        fl.write('1')
-                        self.locked = True
-                        return self.locked
-                idx += .1
-                if idx >= self.timeout:
+                return fcntl.flock(fd, operation | fcntl.LOCK_NB)
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
                     raise Exception('failed to acquire file lock by timeout')
-            except Exception:
-                raise
+                time.sleep(self.retry_interval)
 
     def release(self):
         """ Release file lock """
-        with open(self.lock_path, 'w') as fl:
-            fl.write('0')
+        if self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
         self.locked = None
 
     def __enter__(self):
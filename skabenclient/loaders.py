@@ -1,6 +1,11 @@
+import copy
+import json
 import logging
 import os
+import threading
 import time
+from collections import OrderedDict
+from typing import BinaryIO, Optional
 
 import pygame.mixer as mixer
 import requests
@@ -9,9 +14,11 @@ from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
 
 
-def get_yaml_loader():
+def get_yaml_loader(libyaml: bool = True):
+    """Safe loader with python/tuple support, libyaml-backed when available"""
+    base = yaml.CSafeLoader if libyaml and yaml.__with_libyaml__ else yaml.SafeLoader
 
-    class Loader(yaml.SafeLoader):
+    class Loader(base):
         """ Yaml Loader extended """
         def construct_python_tuple(self, node):
             return tuple(self.construct_sequence(node))
@@ -23,6 +30,20 @@ def get_yaml_loader():
     return Loader
 
 
+def get_yaml_dumper(libyaml: bool = True):
+    """Safe dumper with python/tuple support, libyaml-backed when available"""
+    base = yaml.CSafeDumper if libyaml and yaml.__with_libyaml__ else yaml.SafeDumper
+
+    class Dumper(base):
+        """ Yaml Dumper extended """
+        def represent_python_tuple(self, data):
+            return self.represent_sequence('tag:yaml.org,2002:python/tuple', data)
+
+    Dumper.add_representer(tuple, Dumper.represent_python_tuple)
+
+    return Dumper
+
+
 class SoundLoader:
 
     """ Sound loader
@@ -122,6 +143,117 @@ class SoundLoader:
             raise Exception
 
 
+class BandwidthLimiter:
+    """Token bucket limiting total throughput of downloads sharing it"""
+
+    def __init__(self, rate: int, burst: int = None):
+        self.rate = rate  # bytes per second
+        self.capacity = burst if burst else rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, amount: int):
+        """Take amount of bytes from bucket, sleep while bucket is in debt"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay:
+            time.sleep(delay)
+
+
+class ValidatorCache:
+    """HTTP validators (ETag, Last-Modified) by key, with response bodies of JSON requests
+
+       least recently used entries are dropped when cache is full
+    """
+
+    def __init__(self, size: int = 128):
+        self.size = size
+        self.entries = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+        self.lock = threading.Lock()
+
+    def headers(self, key: str) -> dict:
+        """Conditional request headers for cached key"""
+        with self.lock:
+            entry = self.entries.get(key)
+        if not entry:
+            return {}
+        headers = {}
+        if entry["etag"]:
+            headers["If-None-Match"] = entry["etag"]
+        if entry["last_modified"]:
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def hit(self, key: str):
+        """Count response not modified, return cached body"""
+        with self.lock:
+            self.stats["hits"] += 1
+            entry = self.entries.get(key)
+            if entry:
+                self.entries.move_to_end(key)
+                return copy.deepcopy(entry["body"])
+
+    def discard(self, key: str):
+        """Drop validators, next request is not conditional"""
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def update(self, key: str, headers: dict, body=None):
+        """Count full response, keep validators from its headers"""
+        etag = headers.get("ETag")
+        last_modified = headers.get("Last-Modified")
+        with self.lock:
+            self.stats["misses"] += 1
+            if not (etag or last_modified):
+                self.entries.pop(key, None)
+                return
+            self.entries[key] = {"etag": etag, "last_modified": last_modified, "body": copy.deepcopy(body)}
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.stats["evictions"] += 1
+
+
+class PooledHTTPAdapter(HTTPAdapter):
+    """HTTP adapter counting requests and newly opened connections"""
+
+    def __init__(self, *args, **kwargs):
+        self.stats = {"requests": 0, "new": 0}
+        self.stats_lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+
+    def count(self, key: str):
+        with self.stats_lock:
+            self.stats[key] += 1
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            scheme: self._counting_pool(pool_class)
+            for scheme, pool_class in self.poolmanager.pool_classes_by_scheme.items()
+        }
+
+    def _counting_pool(self, pool_class):
+        count = self.count
+
+        class CountingConnection(pool_class.ConnectionCls):
+            def connect(self):
+                count("new")
+                return super().connect()
+
+        return type(pool_class.__name__, (pool_class,), {"ConnectionCls": CountingConnection})
+
+    def send(self, *args, **kwargs):
+        self.count("requests")
+        return super().send(*args, **kwargs)
+
+
 class HTTPLoader:
     """File loader context manager. Loads file from url
 
@@ -129,33 +261,102 @@ class HTTPLoader:
 
         http = HTTPLoader(system_config, local_directory)
         http.get(url, local_filename)
+
+        HTTP sessions are shared by all loaders in process, connections to server
+        are kept alive and reused between files and between syncs.
+        Repeated requests are conditional, unchanged content is not transferred again.
+        Validators of loaded files are kept apart from JSON responses, by local file path.
     """
 
     retries_number = 3
+    pool_size = 10  # connections kept per host
+    chunk_size = 64 * 1024  # bytes read from stream at once
+    part_suffix = '.part'  # incomplete download
+    meta_suffix = '.meta'  # validators of response partial file was started from
+    cache_size = 128  # JSON responses kept in validator cache
+    file_cache_size = 4096  # loaded files kept in file validator cache
+
+    sessions = {}
+    sessions_lock = threading.Lock()
+    caches = {}
 
     def __init__(self, system_config):
 
+        self.transfer = {}  # metrics of last get_file call
         self.retries = system_config.get('http_retries', self.retries_number)
         self.logger = system_config.logger() or logging
-
+        self.chunk_size = system_config.get('http_chunk_size', self.chunk_size)
+        self.buffer_reuse = system_config.get('http_buffer_reuse', False)
+        self.http = self.get_session(retries=self.retries,
+                                     pool_size=system_config.get('http_pool_size', self.pool_size),
+                                     keepalive=system_config.get('http_keepalive', True),
+                                     auth_token=system_config.get('auth_token'))
+        self.cache = self.get_cache('json', system_config.get('http_cache_size', self.cache_size))
+        self.file_cache = self.get_cache('file', system_config.get('http_file_cache_size', self.file_cache_size))
+
+    @classmethod
+    def get_session(cls, **options) -> requests.Session:
+        """Get pooled session shared by loaders with same options"""
+        key = tuple(sorted(options.items()))
+        with cls.sessions_lock:
+            if key not in cls.sessions:
+                cls.sessions[key] = cls.make_session(**options)
+            return cls.sessions[key]
+
+    @classmethod
+    def get_cache(cls, name: str, size: int) -> ValidatorCache:
+        """Get validator cache shared by loaders"""
+        with cls.sessions_lock:
+            if (name, size) not in cls.caches:
+                cls.caches[(name, size)] = ValidatorCache(size)
+            return cls.caches[(name, size)]
+
+    @staticmethod
+    def make_session(retries: int, pool_size: int, keepalive: bool, auth_token: str = None) -> requests.Session:
         retry_strategy = Retry(
-            total=self.retries,
+            total=retries,
             backoff_factor=1,
             status_forcelist=[429, 500, 502, 503, 504],
             method_whitelist=['HEAD', 'GET', 'OPTIONS']
         )
 
-        adapter = HTTPAdapter(max_retries=retry_strategy)
+        adapter = PooledHTTPAdapter(max_retries=retry_strategy,
+                                    pool_connections=pool_size,
+                                    pool_maxsize=pool_size)
 
         http = requests.Session()
         http.mount('https://', adapter)
         http.mount('http://', adapter)
 
-        auth_token = system_config.get('auth_token')
+        if not keepalive:
+            http.headers.update({'Connection': 'close'})
         if auth_token:
             http.headers.update({'Authorization': f'Token {auth_token}'})
 
-        self.http = http
+        return http
+
+    @classmethod
+    def close_sessions(cls):
+        with cls.sessions_lock:
+            for session in cls.sessions.values():
+                session.close()
+            cls.sessions.clear()
+            cls.caches.clear()
+
+    def connection_stats(self) -> dict:
+        """Count new and reused connections of loader session"""
+        stats = {"requests": 0, "new": 0}
+        for adapter in set(self.http.adapters.values()):
+            for key in stats:
+                stats[key] += adapter.stats[key]
+        stats["reused"] = stats["requests"] - stats["new"]
+        return stats
+
+    def cache_stats(self, cache: ValidatorCache = None) -> dict:
+        """Conditional requests served from cache (hits) and with full response (misses), JSON cache by default"""
+        cache = cache or self.cache
+        with cache.lock:
+            return {**cache.stats, "size": len(cache.entries)}
 
     def parse_url(self, remote_url: str) -> dict:
         arr = remote_url.split('/')
@@ -172,29 +373,174 @@ class HTTPLoader:
         self.logger.debug(f"... retrieving JSON from {remote_url}")
         result = {}
         try:
-            response = self.http.get(remote_url)
+            response = self.http.get(remote_url, headers=self.cache.headers(remote_url))
+            if response.status_code == 304:
+                result = self.cache.hit(remote_url)
+                if result is not None:
+                    return result
+                response = self.http.get(remote_url)
             result = response.json()
+            self.cache.update(remote_url, response.headers, body=result)
         except Exception as e:
             raise Exception(f"... failed to get JSON from {remote_url}: {e}")
         finally:
             return result
 
-    def get_file(self, remote_url: str, local_path: str) -> str:
+    def get_file(self, remote_url: str, local_path: str, limiter: BandwidthLimiter = None, hasher=None,
+                 current: str = None) -> str:
+        """Load file to partial file, move to local path when completed, return loaded file path
+
+           interrupted download is resumed with range request on next call,
+           current file (local path by default) is kept and returned when not modified on server,
+           file content is fed to hashlib object when hasher provided
+        """
         if os.path.isdir(local_path):
             file_name = self.parse_url(remote_url)['file']
             local_path = os.path.join(local_path, file_name)
+        current = current or local_path
+        part_path = f"{local_path}{self.part_suffix}"
+        self.transfer = {"url": remote_url, "bytes": 0, "resumed_from": 0, "retries": 0, "not_modified": False,
+                         "validators": {}}
+        start = time.perf_counter()
 
         try:
             self.logger.debug(f"... retrieving FILE from {remote_url} to {local_path}")
-            response = self.http.get(f"{remote_url}", stream=True)
-            with open(local_path, 'wb') as fh:
-                for data in response.iter_content():
-                    fh.write(data)
+            offset = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+            validators = self.file_cache.headers(current) if not offset and os.path.isfile(current) else {}
+            loaded = self.get_part(remote_url, part_path, offset, limiter, hasher, validators)
+            if loaded is None:
+                self.transfer["not_modified"] = True
+                self.file_cache.hit(current)
+                if hasher:
+                    self.hash_file(current, hasher)
+                return current
+            if not loaded:
+                # partial file is stale, load from scratch
+                self.get_part(remote_url, part_path, 0, limiter, hasher)
+            os.replace(part_path, local_path)
+            self.remove_part_meta(part_path)
+            self.file_cache.update(current, self.transfer["validators"])
             return local_path
         except FileNotFoundError:
             raise
         except Exception as e:
             raise Exception(f'cannot retrieve {remote_url}: {e}')
+        finally:
+            duration = time.perf_counter() - start
+            self.transfer.update(duration=duration,
+                                 throughput=self.transfer["bytes"] / duration if duration else 0)
+
+    def get_part(self, remote_url: str, part_path: str, offset: int = 0, limiter: BandwidthLimiter = None,
+                 hasher=None, validators: dict = None) -> Optional[bool]:
+        """Append file content to partial file starting from offset
+
+           range request is sent with If-Range validator of response partial file was started from,
+           whole file is written when server ignores range request or file was changed,
+           partial file of unknown origin is loaded again,
+           returns False when range cannot be satisfied, None when file is not modified
+        """
+        headers = dict(validators or {})
+        resume = self.resume_headers(part_path, offset) if offset else None
+        if resume is None:
+            offset = 0
+        else:
+            headers.update(resume)
+        with self.http.get(f"{remote_url}", stream=True, headers=headers) as response:
+            retries = getattr(response.raw, 'retries', None)
+            if retries:
+                self.transfer["retries"] += len(retries.history)
+            if validators and response.status_code == 304:
+                response.content  # consume empty body, connection is returned to pool
+                return
+            if offset and not self.range_satisfied(response, offset):
+                return False
+            response.raise_for_status()
+            self.transfer["validators"] = {name: response.headers[name] for name in ('ETag', 'Last-Modified')
+                                           if name in response.headers}
+            if response.status_code != 206:
+                offset = 0
+                self.write_part_meta(part_path, self.transfer["validators"])
+            elif hasher:
+                self.hash_file(part_path, hasher)
+            with open(part_path, 'ab' if offset else 'wb') as fh:
+                written = self.stream(response, fh, limiter, hasher)
+            self.transfer["bytes"] += written
+            length = response.headers.get('Content-Length')
+            if length and 'Content-Encoding' not in response.headers and written < int(length):
+                raise Exception(f'transfer interrupted at {offset + written} bytes')
+        if offset:
+            self.transfer["resumed_from"] = offset
+            self.logger.debug(f"... resumed {remote_url} from {offset} bytes")
+        return True
+
+    def resume_headers(self, part_path: str, offset: int) -> Optional[dict]:
+        """Range request headers for partial file, None when its origin is unknown"""
+        try:
+            with open(f"{part_path}{self.meta_suffix}", 'r') as fh:
+                started = json.load(fh)
+        except (OSError, ValueError):
+            return
+        headers = {'Range': f'bytes={offset}-'}
+        if_range = started.get('ETag') or started.get('Last-Modified')
+        if if_range:
+            headers['If-Range'] = if_range
+        return headers
+
+    @staticmethod
+    def range_satisfied(response: requests.Response, offset: int) -> bool:
+        """Server ignored range (200) or sent content from offset (206)"""
+        if response.status_code == 416:
+            return False
+        content_range = response.headers.get('Content-Range', '')
+        return response.status_code != 206 or content_range.startswith(f'bytes {offset}-')
+
+    def write_part_meta(self, part_path: str, validators: dict):
+        """Keep validators next to partial file, so download is resumed after restart"""
+        with open(f"{part_path}{self.meta_suffix}", 'w') as fh:
+            json.dump(validators, fh)
+
+    def remove_part_meta(self, part_path: str):
+        try:
+            os.remove(f"{part_path}{self.meta_suffix}")
+        except FileNotFoundError:
+            pass
+
+    def hash_file(self, path: str, hasher):
+        """Feed already loaded part of file to hasher"""
+        with open(path, 'rb') as fh:
+            for data in iter(lambda: fh.read(self.chunk_size), b''):
+                hasher.update(data)
+
+    def stream(self, response: requests.Response, fh: BinaryIO, limiter: BandwidthLimiter = None,
+               hasher=None) -> int:
+        """Copy response body to file by chunks, return number of bytes written
+
+           with buffer reuse raw stream is read into single preallocated buffer,
+           used only when response body is not encoded (compressed)
+        """
+        written = 0
+        if self.buffer_reuse and response.headers.get('Content-Encoding', 'identity') == 'identity':
+            buffer = bytearray(self.chunk_size)
+            view = memoryview(buffer)
+            while True:
+                size = response.raw.readinto(buffer)
+                if not size:
+                    break
+                fh.write(view[:size])
+                if hasher:
+                    hasher.update(view[:size])
+                written += size
+                if limiter:
+                    limiter.consume(size)
+        else:
+            for data in response.iter_content(chunk_size=self.chunk_size):
+                fh.write(data)
+                if hasher:
+                    hasher.update(data)
+                written += len(data)
+                if limiter:
+                    limiter.consume(len(data))
+        return written
 
     def __str__(self):
         return f"HTTPLoader <{self.retries_number}>"
@@ -1,9 +1,17 @@
+import signal
+import threading
+
 from skabenclient.config import SystemConfig
 from skabenclient.contexts import Router
 from skabenclient.device import BaseDevice
 from skabenclient.mqtt_client import MQTTClient
 
 
+def terminate(signum, frame):
+    """SIGTERM handler, exit through cleanup as on keyboard interrupt"""
+    raise SystemExit(f'Catch signal {signum}. Exiting')
+
+
 def start_app(app_config: SystemConfig, device: BaseDevice):
     """ Start application
 
@@ -11,12 +19,16 @@ def start_app(app_config: SystemConfig, device: BaseDevice):
         device: end device for user interactions
         event_context: device events controller
 
+        on exit, interrupt or SIGTERM router is stopped and pending state is persisted
     """
 
     app_config.update({'device': device})  # update config for easy access to device instance
     router = Router(app_config)  # initialize router for internal events
     mqtt_client = None
     standalone = app_config.get("standalone")
+    sigterm = None
+    if threading.current_thread() is threading.main_thread():
+        sigterm = signal.signal(signal.SIGTERM, terminate)
 
     try:
         if not standalone:
@@ -29,6 +41,11 @@ def start_app(app_config: SystemConfig, device: BaseDevice):
     except Exception:
         raise
     finally:
+        router.running = False
         router.join(.5)
+        router.close_context()  # write pending timestamp and device config
+        device.flush()  # device config is written even if context was never opened
         if mqtt_client:
             mqtt_client.join(.5)
+        if sigterm is not None:
+            signal.signal(signal.SIGTERM, sigterm)
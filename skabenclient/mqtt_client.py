@@ -1,10 +1,12 @@
-import json
 import time
 from multiprocessing import Process
+from queue import Empty
 from typing import Any
 
+import packets as sp
 import paho.mqtt.client as mqtt
 
+from skabenclient import serializers
 from skabenclient.config import SystemConfig
 from skabenclient.helpers import make_event
 
@@ -47,6 +49,7 @@ class MQTTClient(Process):
     ch = dict()
     subscriptions_info = ''
     default_timeout = 2
+    max_batch = 100  # messages published in one pass
     running = None
 
     def __init__(self, config: SystemConfig):
@@ -63,8 +66,16 @@ class MQTTClient(Process):
 
         # Device
         self.skip_until = 0
+        self.uid = config.get('uid')
         self.pub = config.get('pub')
         self.sub = config.get('sub')
+        self.routes = self.compile_routes(self.sub or [])
+
+        # PING is answered without router when enabled
+        self.fast_ping = config.get('fast_ping', False)
+        self.shared = config.get('shared_state')
+        self.pong_stats = {"fast": 0, "forwarded": 0}
+        self.packets = sp.PacketFactory(self.pub, self.uid, config.get('packet_codec'))
 
         # MQTT broker
         self.broker_ip = config.get('broker_ip')
@@ -139,31 +150,54 @@ class MQTTClient(Process):
 
         try:
             self.logger.debug('MQTT module starting')
-            while self.running:
-                if self.q_ext.empty():
-                    time.sleep(.1)
-                else:
-                    message = self.q_ext.get()
-                    if message[0] == 'exit':
-                        self.stop()
-                    elif message[0] == 'reconnect':
-                        self.reconnect(message[1])
-                    else:
-                        self.logger.debug(f'[SENDING] {message}')
-                        if isinstance(message, tuple):
-                            self.client.publish(*message)
-                        else:
-                            self.logger.debug(f'bad message to publish: {message}')
+            self.publisher()
         except Exception:
             self.logger.exception('catch error in mqtt module: ')
         finally:
             self.client.disconnect(self.client, 0)
 
+    def publisher(self):
+        """Publish outgoing messages as soon as they appear in external queue"""
+        while self.running:
+            for message in self.drain_queue():
+                self.handle_message(message)
+                if not self.running:
+                    return
+
+    def drain_queue(self) -> list:
+        """Block until external queue has messages, return all currently queued"""
+        messages = [self.q_ext.get()]
+        while len(messages) < self.max_batch:
+            try:
+                messages.append(self.q_ext.get_nowait())
+            except Empty:
+                break
+        return messages
+
+    def handle_message(self, message: tuple):
+        """Publish message or manage client by service message"""
+        if not isinstance(message, tuple):
+            self.logger.debug(f'bad message to publish: {message}')
+        elif message[0] == 'wakeup':
+            return
+        elif message[0] == 'exit':
+            self.stop()
+        elif message[0] == 'reconnect':
+            self.reconnect(message[1])
+        else:
+            self.logger.debug(f'[SENDING] {message}')
+            self.client.publish(*message)
+
     def stop(self):
         self.logger.info('mqtt module stopping...')
         exit_message = make_event('exit', 'exit')
         self.q_int.put(exit_message)
         self.running = False
+        self.wakeup()
+
+    def wakeup(self):
+        """Interrupt publisher waiting for external queue"""
+        self.q_ext.put(('wakeup', None))
 
     def reconnect(self, rc: int):
         try:
@@ -212,8 +246,41 @@ class MQTTClient(Process):
             self.q_ext.put(('reconnect', rc))
         else:
             self.running = False
+            self.wakeup()
             self.client.loop_stop(force=True)
 
+    @staticmethod
+    def compile_routes(subscriptions: list) -> dict:
+        """Topic prefix -> (topic, uid) for subscribed patterns like `topic/uid/#`"""
+        routes = {}
+        for pattern in subscriptions:
+            prefix = pattern[:-2] if pattern.endswith('/#') else pattern
+            if '+' in prefix or '#' in prefix:
+                continue
+            routes[prefix] = MQTTClient.parse_topic(prefix)
+        return routes
+
+    @staticmethod
+    def parse_topic(prefix: str) -> tuple:
+        """Split topic without command into (topic, uid)"""
+        parts = prefix.split('/')
+        if len(parts) > 2:
+            raise Exception(f'unsupported topic format: {prefix}')
+        return parts[0], parts[1] if len(parts) == 2 else None
+
+    def reply_pong(self, timestamp: int) -> bool:
+        """Publish PONG from shared state, router still gets PING to persist timestamp
+
+           returns False when fast path is disabled or PING is from the past
+        """
+        if not (self.fast_ping and self.shared and self.shared.advance(timestamp)):
+            self.pong_stats["forwarded"] += 1
+            return False
+        config_hash = self.shared.snapshot()[1]
+        self.client.publish(*self.packets.pong(timestamp, config_hash))
+        self.pong_stats["fast"] += 1
+        return True
+
     def on_message(self, client: mqtt.Client, userdata, msg):
         """Message from MQTT broker received
            receive message as (str, b'{}'), return dict
@@ -222,17 +289,18 @@ class MQTTClient(Process):
         self.logger.debug(f'RECEIVE: {msg.topic} {msg.payload}')
 
         try:
-            full_topic = msg.topic.split('/')
-            if 2 > len(full_topic) > 3:
-                raise Exception(f'unsupported topic format: {full_topic}')
-            payload = json.loads(msg.payload.decode('utf-8'))
-
-            data = dict(topic=full_topic[0],
-                        uid=full_topic[1] if len(full_topic) == 3 else None,
-                        command=full_topic[-1],
+            prefix, _, command = msg.topic.rpartition('/')
+            topic, uid = self.routes.get(prefix) or self.parse_topic(prefix)
+            payload = serializers.decode(msg.payload)
+
+            data = dict(topic=topic,
+                        uid=uid,
+                        command=command,
                         task_id=payload.get('task_id'),
                         timestamp=int(payload.get('timestamp')),
                         datahold=payload.get('datahold'))
+            if command == 'ping':
+                data['replied'] = self.reply_pong(data['timestamp'])
             event = make_event('mqtt', 'new', data)
             self.q_int.put(event)
         except BaseException:
@@ -1,5 +1,26 @@
 import json
-from typing import Optional
+from functools import lru_cache
+from json.encoder import encode_basestring_ascii
+from typing import Any, Optional
+
+from skabenclient.serializers import Codec, JSONCodec, compress, get_codec, get_compressor
+
+json_codec = JSONCodec()
+
+
+@lru_cache(maxsize=256)
+def make_topic(topic: str, uid: Optional[str], command: str) -> str:
+    """Packet topic, cached per (topic, uid, command)"""
+    return "/".join([_ for _ in (topic, uid, command) if _ not in (None, "")])
+
+
+def encode_value(value: Any) -> str:
+    """JSON representation of single value, same as json.dumps"""
+    if type(value) is str:
+        return encode_basestring_ascii(value)
+    if type(value) is int:
+        return int.__repr__(value)
+    return json.dumps(value)
 
 
 class BasePacket:
@@ -7,6 +28,7 @@ class BasePacket:
         Base packet class
     """
 
+    __slots__ = ('topic', 'payload')
     command = str()
 
     def __init__(self,
@@ -14,16 +36,16 @@ class BasePacket:
                  uid: Optional[str] = None,
                  timestamp: Optional[int] = None,
                  config_hash: Optional[str] = None):
-        self.topic = "/".join([_ for _ in (topic, uid, self.command) if _ not in (None, "")])
+        self.topic = make_topic(topic, uid, self.command)
         self.payload = {
             "timestamp": timestamp if timestamp else 0  # assign timestamp if provided
         }
         if config_hash:
             self.payload.update(hash=config_hash)
 
-    def encode(self):
+    def encode(self, codec: Optional[Codec] = None):
         try:
-            payload = json.dumps(self.payload).encode('utf-8')
+            payload = (codec or json_codec).dumps(self.payload)
             return tuple((self.topic, payload))
         except Exception:
             raise
@@ -38,11 +60,14 @@ class PING(BasePacket):
     """
         Ping packet. Broadcast only.
     """
+
+    __slots__ = ()
+    command = "ping"
+
     def __init__(self,
                  topic: str,
                  uid: Optional[str] = None,
                  timestamp: Optional[int] = None):
-        self.command = "ping"
         super().__init__(topic=topic,
                          uid=uid,
                          timestamp=timestamp)
@@ -54,12 +79,15 @@ class PONG(BasePacket):
         Should send timestamp value of PING
         Can send config hash as .conf attribute
     """
+
+    __slots__ = ()
+    command = "pong"
+
     def __init__(self,
                  topic: str,
                  uid: str,
                  timestamp: int,
                  config_hash: Optional[str] = None):
-        self.command = "pong"
         super().__init__(topic=topic,
                          uid=uid,
                          timestamp=timestamp,
@@ -72,8 +100,11 @@ class WAIT(BasePacket):
         before sending another PONG client should either
         wait timeout or receive nowait-packet (CUP/SUP)
     """
+
+    __slots__ = ()
+    command = "wait"
+
     def __init__(self, topic: str, timeout: int, uid: str, timestamp: int):
-        self.command = "wait"
         super().__init__(topic=topic,
                          uid=uid,
                          timestamp=timestamp)
@@ -91,8 +122,11 @@ class ACK(BasePacket):
         Confirm operations on previous packet as successful
         Should send ts of previous packet
     """
+
+    __slots__ = ()
+    command = "ack"
+
     def __init__(self, topic: str, task_id: str, uid: str, timestamp: int, config_hash: str):
-        self.command = "ack"
         super().__init__(topic=topic,
                          uid=uid,
                          timestamp=timestamp,
@@ -105,8 +139,11 @@ class NACK(BasePacket):
         Confirm operations on previous packet as unsuccessful
         Should send ts of previous packet
     """
+
+    __slots__ = ()
+    command = "nack"
+
     def __init__(self, topic: str, task_id: str, uid: str, timestamp: int, config_hash: str):
-        self.command = "nack"
         super().__init__(topic=topic,
                          uid=uid,
                          timestamp=timestamp,
@@ -122,6 +159,7 @@ class DataholdPacket(BasePacket):
         Loaded packet basic class.
     """
 
+    __slots__ = ()
     datahold = {}  # packet data load
 
     def __init__(self,
@@ -144,13 +182,16 @@ class INFO(DataholdPacket):
     """
         Multipurpose payload packet
     """
+
+    __slots__ = ()
+    command = "info"
+
     def __init__(self,
                  topic: str,
                  datahold: dict,
                  uid: str,
                  timestamp: int,
                  task_id: Optional[str] = None):
-        self.command = "info"
         super().__init__(topic=topic,
                          datahold=datahold,
                          timestamp=timestamp,
@@ -162,13 +203,16 @@ class SUP(DataholdPacket):
     """
         State Update - update server config and global dungeon state
     """
+
+    __slots__ = ()
+    command = "sup"
+
     def __init__(self,
                  topic: str,
                  datahold: dict,
                  uid: str,
                  timestamp: int,
                  task_id: Optional[str] = None):
-        self.command = "sup"
         super().__init__(topic=topic,
                          datahold=datahold,
                          task_id=task_id,
@@ -180,6 +224,10 @@ class CUP(DataholdPacket):
     """
         Client/Config Update - update client config
     """
+
+    __slots__ = ()
+    command = "cup"
+
     def __init__(self,
                  topic: str,
                  datahold: dict,
@@ -187,10 +235,97 @@ class CUP(DataholdPacket):
                  timestamp: int,
                  uid: Optional[str] = None,
                  config_hash: Optional[str] = None):
-        self.command = "cup"
         super().__init__(topic=topic,
                          datahold=datahold,
                          task_id=task_id,
                          uid=uid,
                          timestamp=timestamp,
                          config_hash=config_hash)
+
+
+class PacketFactory:
+    """
+        Encoded packets of single device
+
+        Topics are prepared once per command, with default JSON codec payloads
+        of known shape are built from string templates instead of dict + json.dumps.
+        Result is equal to encode() of corresponding packet.
+        Other codecs are advertised to server in PONG.
+
+        With compression enabled datahold encoded larger than threshold is
+        compressed (base64 for JSON codecs) and flagged by "compression" key.
+    """
+
+    __slots__ = ('topics', 'codec', 'templates', 'compressor', 'threshold', '_hash', '_hash_part')
+    packets = (PING, PONG, WAIT, ACK, NACK, INFO, SUP, CUP)
+    default_threshold = 4096
+
+    def __init__(self,
+                 topic: str,
+                 uid: Optional[str] = None,
+                 codec: Optional[str] = None,
+                 compression: Optional[str] = None,
+                 compress_threshold: Optional[int] = None):
+        self.topics = {packet.command: make_topic(topic, uid, packet.command) for packet in self.packets}
+        self.codec = get_codec(codec)
+        self.templates = self.codec.name == JSONCodec.name
+        self.compressor = get_compressor(compression) if compression else None
+        self.threshold = self.default_threshold if compress_threshold is None else compress_threshold
+        self._hash = None
+        self._hash_part = ''
+
+    def build(self, command: str, timestamp: Optional[int], config_hash: Optional[str] = None, **fields) -> tuple:
+        """Encode payload dict with packet codec"""
+        payload = {"timestamp": timestamp if timestamp else 0}
+        if config_hash:
+            payload["hash"] = config_hash
+        payload.update(fields)
+        return self.topics[command], self.codec.dumps(payload)
+
+    def head(self, timestamp: Optional[int], config_hash: Optional[str] = None) -> str:
+        """Common payload start: timestamp and config hash"""
+        if config_hash != self._hash:
+            self._hash = config_hash
+            self._hash_part = f', "hash": {encode_value(config_hash)}' if config_hash else ''
+        return f'{{"timestamp": {encode_value(timestamp if timestamp else 0)}{self._hash_part}'
+
+    def pong(self, timestamp: int, config_hash: Optional[str] = None) -> tuple:
+        if not self.templates:
+            return self.build('pong', timestamp, config_hash, codec=self.codec.name)
+        return self.topics['pong'], f'{self.head(timestamp, config_hash)}}}'.encode('utf-8')
+
+    def confirm(self, command: str, task_id: str, timestamp: int, config_hash: Optional[str] = None) -> tuple:
+        """ACK or NACK"""
+        if not self.templates:
+            return self.build(command, timestamp, config_hash, task_id=task_id)
+        payload = f'{self.head(timestamp, config_hash)}, "task_id": {encode_value(task_id)}}}'
+        return self.topics[command], payload.encode('utf-8')
+
+    def datahold(self, command: str, datahold: dict, timestamp: int, task_id: Optional[str] = None,
+                 config_hash: Optional[str] = None) -> tuple:
+        """INFO, SUP or CUP"""
+        if not self.templates:
+            fields = {"datahold": datahold}
+            if self.compressor:
+                fields.update(self.compress(self.codec.dumps(datahold)))
+            if task_id:
+                fields.update(task_id=task_id)
+            return self.build(command, timestamp, config_hash, **fields)
+        body = json.dumps(datahold)
+        if self.compressor:
+            compressed = self.compress(body.encode('utf-8'))
+            if compressed:
+                body = f'{encode_value(compressed["datahold"])}, "compression": "{compressed["compression"]}"'
+        payload = f'{self.head(timestamp, config_hash)}, "datahold": {body}'
+        if task_id:
+            payload += f', "task_id": {encode_value(task_id)}'
+        return self.topics[command], f'{payload}}}'.encode('utf-8')
+
+    def compress(self, encoded: bytes) -> dict:
+        """Compressed datahold fields, empty when datahold is small or not compressible"""
+        if len(encoded) <= self.threshold:
+            return {}
+        compressed = compress(encoded, self.compressor, self.codec.binary)
+        if len(compressed) >= len(encoded):
+            return {}
+        return {"datahold": compressed, "compression": self.compressor.name}
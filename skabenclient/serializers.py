@@ -0,0 +1,191 @@
+import base64
+import json
+import zlib
+from typing import Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class Codec:
+
+    """ Packet payload codec base class
+
+        Payload is always a dict encoded to bytes.
+    """
+
+    name = None
+    binary = False  # payload can hold raw bytes
+
+    def dumps(self, data: dict) -> bytes:
+        raise NotImplementedError
+
+    def loads(self, payload: bytes) -> dict:
+        raise NotImplementedError
+
+    def __str__(self):
+        return f"{self.__class__.__name__} <{self.name}>"
+
+
+class JSONCodec(Codec):
+
+    name = 'json'
+
+    def dumps(self, data: dict) -> bytes:
+        return json.dumps(data).encode('utf-8')
+
+    def loads(self, payload: bytes) -> dict:
+        return json.loads(payload)
+
+
+class FastJSONCodec(Codec):
+
+    """ Compact JSON with orjson, readable by any JSON decoder """
+
+    name = 'orjson'
+
+    def __init__(self):
+        if not orjson:
+            raise ImportError('orjson package is required for orjson packet codec')
+
+    def dumps(self, data: dict) -> bytes:
+        return orjson.dumps(data)
+
+    def loads(self, payload: bytes) -> dict:
+        return orjson.loads(payload)
+
+
+class MsgpackCodec(Codec):
+
+    name = 'msgpack'
+    binary = True
+
+    def __init__(self):
+        if not msgpack:
+            raise ImportError('msgpack package is required for msgpack packet codec')
+
+    def dumps(self, data: dict) -> bytes:
+        return msgpack.packb(data)
+
+    def loads(self, payload: bytes) -> dict:
+        return msgpack.unpackb(payload)
+
+
+codecs = {
+    codec.name: codec
+    for codec in (JSONCodec, FastJSONCodec, MsgpackCodec)
+}
+
+
+def get_codec(name: str = None) -> Codec:
+    """Make packet codec by name, stdlib JSON by default"""
+    codec = codecs.get(name or JSONCodec.name)
+    if not codec:
+        raise Exception(f'unknown packet codec: {name}, use one of {list(codecs)}')
+    return codec()
+
+
+class Compressor:
+
+    """ Datahold compression base class """
+
+    name = None
+
+    def compress(self, data: bytes) -> bytes:
+        raise NotImplementedError
+
+    def decompress(self, data: bytes) -> bytes:
+        raise NotImplementedError
+
+    def __str__(self):
+        return f"{self.__class__.__name__} <{self.name}>"
+
+
+class ZlibCompressor(Compressor):
+
+    name = 'zlib'
+    level = 6
+
+    def compress(self, data: bytes) -> bytes:
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data: bytes) -> bytes:
+        return zlib.decompress(data)
+
+
+class ZstdCompressor(Compressor):
+
+    name = 'zstd'
+    level = 3
+
+    def __init__(self):
+        if not zstandard:
+            raise ImportError('zstandard package is required for zstd compression')
+
+    def compress(self, data: bytes) -> bytes:
+        return zstandard.compress(data, self.level)
+
+    def decompress(self, data: bytes) -> bytes:
+        return zstandard.decompress(data)
+
+
+compressors = {
+    compressor.name: compressor
+    for compressor in (ZlibCompressor, ZstdCompressor)
+}
+
+
+def get_compressor(name: str) -> Compressor:
+    """Make datahold compressor by name"""
+    compressor = compressors.get(name)
+    if not compressor:
+        raise Exception(f'unknown compression: {name}, use one of {list(compressors)}')
+    return compressor()
+
+
+def compress(encoded: bytes, compressor: Compressor, binary: bool = False) -> Union[bytes, str]:
+    """Compress encoded datahold, base64 string for text codecs"""
+    data = compressor.compress(encoded)
+    return data if binary else base64.b64encode(data).decode('ascii')
+
+
+def inflate(payload: dict) -> dict:
+    """Replace compressed datahold of received payload with decoded one"""
+    data = payload['datahold']
+    if isinstance(data, str):
+        data = base64.b64decode(data)
+    payload['datahold'] = decode(get_compressor(payload.pop('compression')).decompress(data))
+    return payload
+
+
+def is_msgpack(payload: bytes) -> bool:
+    """Payload is MessagePack map (fixmap, map16 or map32), JSON objects start with '{' """
+    return bool(payload) and (0x80 <= payload[0] <= 0x8f or payload[0] in (0xde, 0xdf))
+
+
+# received JSON is decoded with the fastest available decoder
+_json = FastJSONCodec() if orjson else JSONCodec()
+_msgpack = MsgpackCodec() if msgpack else None
+
+
+def decode(payload: bytes) -> dict:
+    """Decode received payload, codec is detected by first byte, compressed datahold is inflated"""
+    if _msgpack and is_msgpack(payload):
+        result = _msgpack.loads(payload)
+    else:
+        result = _json.loads(payload)
+    if result.get('compression'):
+        return inflate(result)
+    return result
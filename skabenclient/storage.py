@@ -0,0 +1,257 @@
+import copy
+import json
+import os
+import sqlite3
+import time
+from typing import Iterable, TextIO, Union
+
+import yaml
+
+from skabenclient.helpers import FileLock
+from skabenclient.loaders import get_yaml_dumper, get_yaml_loader
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+ExtendedLoader = get_yaml_loader()
+ExtendedDumper = get_yaml_dumper()
+
+# storage content is empty, missing or cannot be parsed
+read_errors = (EOFError, FileNotFoundError, yaml.YAMLError, ValueError, sqlite3.DatabaseError)
+
+# python/tuple values supported by yaml loader are kept as tuples in other formats,
+# in JSON tuples and objects having type key are wrapped into typed objects
+type_key = '__type__'
+tuple_ext = 1
+
+
+def encode_tuples(data):
+    """Wrap tuples for JSON, which has arrays only"""
+    if isinstance(data, tuple):
+        return {type_key: 'tuple', 'items': [encode_tuples(item) for item in data]}
+    if isinstance(data, list):
+        return [encode_tuples(item) for item in data]
+    if isinstance(data, dict):
+        encoded = {key: encode_tuples(value) for key, value in data.items()}
+        return {type_key: 'dict', 'items': encoded} if type_key in data else encoded
+    return data
+
+
+def decode_tuples(data):
+    """Unwrap typed objects of decoded JSON"""
+    if isinstance(data, list):
+        return [decode_tuples(item) for item in data]
+    if isinstance(data, dict):
+        if type_key not in data:
+            return {key: decode_tuples(value) for key, value in data.items()}
+        if data[type_key] == 'tuple':
+            return tuple(decode_tuples(item) for item in data['items'])
+        return {key: decode_tuples(value) for key, value in data['items'].items()}
+    return data
+
+
+def json_dumps(data) -> str:
+    return json.dumps(encode_tuples(data), separators=(',', ':'))
+
+
+def json_loads(content: str):
+    return decode_tuples(json.loads(content))
+
+
+def yaml_load(target: Union[str, TextIO]) -> dict:
+    """Loads yaml from given string or file"""
+    result = yaml.load(target, Loader=ExtendedLoader)
+    if not result:
+        raise EOFError(f"{target} cannot be loaded")
+    return result
+
+
+class Storage:
+
+    """ Config storage base class
+
+        Keeps whole config document in single file guarded by FileLock.
+        Unchanged file is not parsed again.
+    """
+
+    name = None
+    extension = None
+    binary = False
+    # files modified less than this number of seconds before read are not cached,
+    # same-size rewrites can share mtime on filesystems with coarse timestamps
+    cache_racy_window = 2
+
+    def __init__(self, path: str):
+        self.path = path
+        self._read_cache = None
+
+    def parse(self, fh) -> dict:
+        raise NotImplementedError
+
+    def dump(self, data: dict) -> Union[str, bytes]:
+        raise NotImplementedError
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def read(self) -> dict:
+        """ Reads document from file """
+        with FileLock(self.path, shared=True):
+            stat = os.stat(self.path)
+            key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            if self._read_cache and self._read_cache[0] == key:
+                return copy.deepcopy(self._read_cache[1])
+            with open(self.path, 'rb' if self.binary else 'r') as fh:
+                result = self.parse(fh)
+            if time.time() - stat.st_mtime > self.cache_racy_window:
+                self._read_cache = (key, copy.deepcopy(result))
+            return result
+
+    def write(self, data: dict, keys: Iterable[str] = None, mode: str = 'w'):
+        """ Writes whole document to file, changed keys are not used """
+        dump = self.dump(data)
+        with FileLock(self.path):
+            with open(self.path, f'{mode}b' if self.binary else mode) as fh:
+                fh.write(dump)
+            self._read_cache = None
+
+    def __str__(self):
+        return f"{self.__class__.__name__} <{self.path}>"
+
+
+class YAMLStorage(Storage):
+
+    name = 'yaml'
+    extension = '.yml'
+
+    def parse(self, fh: TextIO) -> dict:
+        return yaml_load(fh)
+
+    def dump(self, data: dict) -> str:
+        return yaml.dump(data, Dumper=ExtendedDumper, default_flow_style=False)
+
+
+class JSONStorage(Storage):
+
+    name = 'json'
+    extension = '.json'
+
+    def parse(self, fh: TextIO) -> dict:
+        content = fh.read()
+        if not content:
+            raise EOFError(f"{self.path} is empty")
+        return json_loads(content)
+
+    def dump(self, data: dict) -> str:
+        return json_dumps(data)
+
+
+class MsgpackStorage(Storage):
+
+    name = 'msgpack'
+    extension = '.msgpack'
+    binary = True
+
+    def __init__(self, path: str):
+        if not msgpack:
+            raise ImportError('msgpack package is required for msgpack config storage')
+        super().__init__(path)
+
+    def parse(self, fh) -> dict:
+        content = fh.read()
+        if not content:
+            raise EOFError(f"{self.path} is empty")
+        return msgpack.unpackb(content, ext_hook=self.unpack_ext)
+
+    def dump(self, data: dict) -> bytes:
+        return msgpack.packb(data, strict_types=True, default=self.pack_default)
+
+    @classmethod
+    def pack_default(cls, obj):
+        """Pack tuples as extension type, strict types pass them here instead of packing as arrays"""
+        if isinstance(obj, tuple):
+            return msgpack.ExtType(tuple_ext, msgpack.packb(list(obj), strict_types=True, default=cls.pack_default))
+        if isinstance(obj, dict):
+            return dict(obj)
+        if isinstance(obj, list):
+            return list(obj)
+        raise TypeError(f'cannot serialize {type(obj)}')
+
+    @classmethod
+    def unpack_ext(cls, code: int, data: bytes):
+        if code == tuple_ext:
+            return tuple(msgpack.unpackb(data, ext_hook=cls.unpack_ext))
+        return msgpack.ExtType(code, data)
+
+
+class SQLiteStorage(Storage):
+
+    """ Key-value storage, every top-level config key is a separate row
+
+        Only changed keys are written on partial update.
+    """
+
+    name = 'sqlite'
+    extension = '.sqlite'
+    timeout = 5
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        db = self.connect()
+        try:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('CREATE TABLE IF NOT EXISTS config (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        finally:
+            db.close()
+
+    def connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=self.timeout)
+
+    def query(self, sql: str) -> list:
+        db = self.connect()
+        try:
+            return db.execute(sql).fetchall()
+        finally:
+            db.close()
+
+    def exists(self) -> bool:
+        return bool(self.query('SELECT 1 FROM config LIMIT 1'))
+
+    def read(self) -> dict:
+        rows = self.query('SELECT key, value FROM config')
+        if not rows:
+            raise EOFError(f"{self.path} is empty")
+        return {key: json_loads(value) for key, value in rows}
+
+    def write(self, data: dict, keys: Iterable[str] = None, mode: str = 'w'):
+        """ Writes changed keys only, whole document when keys are not provided """
+        db = self.connect()
+        try:
+            with db:
+                if keys is None:
+                    db.execute('DELETE FROM config')
+                    keys = data.keys()
+                removed = [(key,) for key in keys if key not in data]
+                changed = [(key, json_dumps(data[key])) for key in keys if key in data]
+                db.executemany('DELETE FROM config WHERE key = ?', removed)
+                db.executemany('INSERT OR REPLACE INTO config (key, value) VALUES (?, ?)', changed)
+        finally:
+            db.close()
+
+
+backends = {
+    storage.name: storage
+    for storage in (YAMLStorage, JSONStorage, MsgpackStorage, SQLiteStorage)
+}
+
+
+def get_storage(name: str, config_path: str) -> Storage:
+    """Make storage backend by name, file path derived from config path"""
+    storage = backends.get(name)
+    if not storage:
+        raise Exception(f'unknown config storage backend: {name}, use one of {list(backends)}')
+    if storage is YAMLStorage:
+        return storage(config_path)
+    return storage(os.path.splitext(config_path)[0] + storage.extension)
@@ -1,4 +1,6 @@
-import json
+import time
+
+from skabenclient import serializers
 
 
 class MockMessage:
@@ -6,7 +8,7 @@ class MockMessage:
     def __init__(self, packet):
         self.topic = packet[0]
         self.payload = packet[1]
-        self.decoded = json.loads(self.payload.decode('utf-8'))
+        self.decoded = serializers.decode(self.payload)
 
 
 class MockQueue:
@@ -18,4 +20,21 @@ class MockQueue:
         self.data.append(value)
 
     def get(self):
-        return self.data.pop()
\ No newline at end of file
+        return self.data.pop()
+
+
+class MockBroker:
+
+    """In-process stand-in for paho client, records published messages"""
+
+    def __init__(self):
+        self.published = []
+
+    def publish(self, topic, payload=None, *args):
+        self.published.append((time.perf_counter(), topic, payload))
+
+    def disconnect(self, *args):
+        return
+
+    def loop_stop(self, *args, **kwargs):
+        return
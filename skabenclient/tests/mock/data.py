@@ -50,4 +50,12 @@ yaml_content_as_dict = {'play': False,
                                              'remote': 'url://',
                                              'repeat': '2'}
                                         },
-                        'uid': '000c290c07cf'}
\ No newline at end of file
+                        'uid': '000c290c07cf'}
+
+
+def make_assets(number):
+    """Assets map of given size as stored in device config"""
+    return {f'{idx:08x}': {'local_path': f'/opt/assets/sound/file_{idx}.ogg',
+                           'hash': f'{idx:08x}',
+                           'url': f'http://127.0.0.1/media/sound/file_{idx}.ogg',
+                           'file_type': 'sound'} for idx in range(number)}
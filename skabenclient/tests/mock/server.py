@@ -0,0 +1,112 @@
+import os
+import threading
+import time
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+
+class AssetHandler(SimpleHTTPRequestHandler):
+
+    """ Static files handler with emulated network latency, range requests, ETags and dropped connections """
+
+    protocol_version = 'HTTP/1.1'  # keep-alive connections
+    etag = None
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        if self.headers.get('Range'):
+            self.server.range_requests.append((self.path, self.headers['Range']))
+        time.sleep(self.server.delay)
+        super().do_GET()
+
+    def end_headers(self):
+        if self.etag:
+            self.send_header('ETag', self.etag)
+        super().end_headers()
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        self.etag = None
+        if self.server.etags and os.path.isfile(path):
+            stat = os.stat(path)
+            self.etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+            if self.headers.get('If-None-Match') == self.etag:
+                self.send_response(304)
+                self.end_headers()
+                return
+        range_header = self.headers.get('Range')
+        if_range = self.headers.get('If-Range')
+        if if_range and os.path.isfile(path) and \
+                if_range not in (self.etag, self.date_time_string(int(os.stat(path).st_mtime))):
+            # file changed since partial download, send whole file
+            range_header = None
+        if not (self.server.ranges and range_header):
+            return super().send_head()
+        try:
+            fh = open(path, 'rb')
+        except OSError:
+            self.send_error(404)
+            return
+        size = os.fstat(fh.fileno()).st_size
+        start = int(range_header.split('=')[1].split('-')[0])
+        if start >= size:
+            fh.close()
+            self.send_error(416)
+            return
+        fh.seek(start)
+        self.send_response(206)
+        self.send_header('Content-Type', self.guess_type(path))
+        self.send_header('Content-Range', f'bytes {start}-{size - 1}/{size}')
+        self.send_header('Content-Length', str(size - start))
+        self.end_headers()
+        return fh
+
+    def copyfile(self, source, outputfile):
+        if self.server.drop_after:
+            # send part of file and drop connection once
+            outputfile.write(source.read(self.server.drop_after))
+            self.server.drop_after = 0
+            self.close_connection = True
+            return
+        super().copyfile(source, outputfile)
+
+    def log_message(self, *args):
+        return
+
+
+class AssetServer:
+
+    """ Local HTTP stand-in for asset server, serves files from directory """
+
+    def __init__(self, directory: str, delay: float = 0, ranges: bool = True, etags: bool = True):
+        handler = partial(AssetHandler, directory=directory)
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self.httpd.daemon_threads = True
+        self.httpd.delay = delay
+        self.httpd.requests = []
+        self.httpd.ranges = ranges
+        self.httpd.etags = etags
+        self.httpd.drop_after = 0
+        self.httpd.range_requests = []
+        self.url = f'http://127.0.0.1:{self.httpd.server_port}'
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def requests(self):
+        return self.httpd.requests
+
+    @property
+    def range_requests(self):
+        return self.httpd.range_requests
+
+    def drop_after(self, size: int):
+        """drop connection after given number of bytes on next request"""
+        self.httpd.drop_after = size
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
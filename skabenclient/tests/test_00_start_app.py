@@ -1,4 +1,6 @@
 import logging
+import os
+import signal
 import threading
 import time
 from queue import Queue
@@ -8,7 +10,7 @@ import pytest
 from skabenclient.config import DeviceConfig, SystemConfig
 from skabenclient.contexts import EventContext, Router
 from skabenclient.device import BaseDevice
-from skabenclient.helpers import make_event
+from skabenclient.helpers import TimestampStore, make_event
 from skabenclient.main import start_app
 from skabenclient.mqtt_client import MQTTClient
 
@@ -28,7 +30,11 @@ def get_router(get_config, default_config):
     syscfg.update({'device': device})
     router = Router(syscfg)
 
-    return router, syscfg, devcfg
+    yield router, syscfg, devcfg
+    # stop router thread before its queues are closed
+    if router.is_alive():
+        router.running = False
+        router.join(1)
 
 
 @pytest.fixture
@@ -95,6 +101,60 @@ def test_start_app_routine(get_config, default_config, get_from_queue, monkeypat
         assert service in result, f'{service} not started'
 
 
+@pytest.mark.parametrize('interrupt', ('keyboard', 'sigterm'))
+def test_start_app_interrupt_flush(get_config, default_config, monkeypatch, tmp_path, interrupt):
+    """ Test pending timestamp is written when application is interrupted """
+    devcfg = get_config(DeviceConfig, default_config('dev'), fname='test_cfg.yml')
+    devcfg.save()
+    syscfg = get_config(SystemConfig, {**default_config('sys'), 'standalone': True})
+    syscfg.root = str(tmp_path)
+    device = BaseDevice(syscfg, devcfg)
+    timestamp_path = os.path.join(syscfg.root, 'timestamp')
+    handler = signal.getsignal(signal.SIGTERM)
+
+    def _interrupted(*args):
+        router = next(thread for thread in threading.enumerate() if isinstance(thread, Router))
+        for _ in range(50):
+            if router.context:
+                break
+            time.sleep(.02)
+        router.context.rewrite_timestamp(1600000000)
+        if interrupt == 'sigterm':
+            os.kill(os.getpid(), signal.SIGTERM)
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(BaseDevice, 'run', _interrupted)
+    with pytest.raises(SystemExit):
+        start_app(app_config=syscfg, device=device)
+
+    assert TimestampStore(timestamp_path).load() == 1600000000, 'pending timestamp lost'
+    assert signal.getsignal(signal.SIGTERM) == handler, 'SIGTERM handler not restored'
+
+
+def test_start_app_interrupt_flush_device_config(get_config, default_config, monkeypatch, tmp_path):
+    """ Test input saved in write-behind mode is written when application is interrupted """
+    devcfg = get_config(DeviceConfig, default_config('dev'), fname='test_cfg.yml')
+    devcfg.save()
+    syscfg = get_config(SystemConfig, {**default_config('sys'), 'standalone': True, 'config_write_behind': 60})
+    syscfg.root = str(tmp_path)
+    device = BaseDevice(syscfg, devcfg)
+
+    def _broken(*args):
+        raise Exception('broken context')
+
+    def _interrupted(*args):
+        device.config.save({'int': 42})
+        raise KeyboardInterrupt
+
+    # router never opens its context
+    monkeypatch.setattr(EventContext, '__init__', _broken)
+    monkeypatch.setattr(BaseDevice, 'run', _interrupted)
+    with pytest.raises(SystemExit):
+        start_app(app_config=syscfg, device=device)
+
+    assert DeviceConfig(devcfg.config_path).read()['int'] == 42, 'pending device config lost'
+
+
 @pytest.mark.skip(reason="bad queue timings management")
 def test_router_start_stop(get_router, monkeypatch, caplog):
     router, syscfg, devcfg = get_router
@@ -127,6 +187,46 @@ def test_router_exit_by_event(get_router, request, get_from_queue):
     assert router.running is False, 'router was not stopped'
 
 
+def test_router_stop_wakes_up(get_router):
+    """ Test idle router blocked on queues exits when stopped """
+    router, syscfg, devcfg = get_router
+    router.start()
+    time.sleep(.1)
+
+    router.running = False
+    router.join(1)
+    assert not router.is_alive(), 'router still waits for queues'
+
+
+def test_router_context_error(get_router, monkeypatch, caplog):
+    """ Test router logs event context creation error and exits """
+    router, syscfg, devcfg = get_router
+
+    def _broken(*args):
+        raise Exception('broken context')
+
+    monkeypatch.setattr(EventContext, '__init__', _broken)
+    router.start()
+    router.join(1)
+
+    assert not router.is_alive(), 'router not stopped'
+    assert 'broken context' in caplog.text, 'context error not logged'
+
+
+def test_router_context_closed_once(get_router, monkeypatch):
+    """ Test context is closed once on exit event """
+    router, syscfg, devcfg = get_router
+    closed = []
+    monkeypatch.setattr(EventContext, 'close', lambda ctx: closed.append(ctx))
+    router.start()
+
+    syscfg.get('q_int').put(make_event('exit'))
+    router.join(5)
+
+    assert not router.is_alive(), 'router not stopped'
+    assert len(closed) == 1, 'context closed more than once'
+
+
 def test_router_event_mqtt(get_router, monkeypatch, get_from_queue):
     router, syscfg, devcfg = get_router
     test_queue = Queue()
@@ -160,3 +260,91 @@ def test_router_event_device(get_router, monkeypatch, get_from_queue, event_data
     assert result[0].type == 'device'
     assert result[0].cmd == 'test'
     assert result[0].data == event_data
+
+
+def test_router_exit_flushes_device_config(get_router, request):
+    """ Test no input saved in write-behind mode is lost on clean shutdown """
+    router, syscfg, devcfg = get_router
+    devcfg.write_behind = 60
+    devcfg.flush_stats = {'saves': 0, 'flushes': 0}
+    router.start()
+    request.addfinalizer(lambda: router.join(.1))
+
+    for idx in range(10):
+        syscfg.get('q_int').put(make_event('device', 'input', {'slider': idx, f'key_{idx}': idx}))
+    syscfg.get('q_int').put(make_event('exit'))
+    router.join(5)
+
+    saved = devcfg.read()
+    assert not router.running, 'router was not stopped'
+    assert devcfg.flush_stats['saves'] == 10
+    assert devcfg.flush_stats['flushes'] == 1, 'saves were not coalesced'
+    assert saved.get('slider') == 9
+    assert all(saved.get(f'key_{idx}') == idx for idx in range(10)), 'input lost on shutdown'
+
+
+@pytest.mark.parametrize('window', (0, .3))
+def test_router_coalesce_input(get_router, monkeypatch, get_from_queue, window):
+    """ Test consecutive input events are merged and order of other events is kept """
+    router, syscfg, devcfg = get_router
+    router.coalesce_window = window
+    test_queue = Queue()
+    monkeypatch.setattr(EventContext, 'manage', lambda x, y: test_queue.put((y.cmd, y.data)))
+    events = [('input', {'slider': 1, 'uid': 'test'}),
+              ('input', {'slider': 2, 'uid': 'test'}),
+              ('input', {'switch': True, 'uid': 'test'}),
+              ('info', {'message': 'test'}),
+              ('input', {'slider': 3, 'uid': 'test'})]
+    for cmd, data in events:
+        syscfg.get('q_int').put(make_event('device', cmd, data))
+    router.start()
+
+    result = list(get_from_queue(test_queue))
+    router.running = False
+    router.join(1)
+
+    if not window:
+        assert result == events, 'events changed without coalescing'
+        assert router.input_stats == {'received': 4, 'merged': 0, 'dispatched': 4}
+    else:
+        assert result == [('input', {'slider': 2, 'switch': True, 'uid': 'test'}),
+                          ('info', {'message': 'test'}),
+                          ('input', {'slider': 3, 'uid': 'test'})], 'bad coalescing order'
+        assert router.input_stats == {'received': 4, 'merged': 2, 'dispatched': 2}
+
+
+def _collect_latency(router, syscfg, monkeypatch, bursts):
+    """Put timestamped events into internal queue, measure enqueue-to-absorb time"""
+    latency = Queue()
+    monkeypatch.setattr(EventContext, 'absorb',
+                        lambda ctx, event: latency.put(time.perf_counter() - event.data['sent']))
+    router.start()
+
+    total = 0
+    for burst_size, pause in bursts:
+        for _ in range(burst_size):
+            syscfg.get('q_int').put(make_event('device', 'test', {'sent': time.perf_counter()}))
+            total += 1
+        time.sleep(pause)
+
+    result = [latency.get(timeout=5) for _ in range(total)]
+    router.running = False
+    router.join(1)
+    return sorted(result)
+
+
+@pytest.mark.parametrize('load, bursts', (
+    ('steady', [(1, .01)] * 50),
+    ('bursty', [(50, .2)] * 4),
+))
+def test_router_latency_benchmark(get_router, monkeypatch, load, bursts):
+    """Benchmark enqueue-to-absorb latency of router under steady and bursty load"""
+    router, syscfg, devcfg = get_router
+    result = _collect_latency(router, syscfg, monkeypatch, bursts)
+
+    median = result[len(result) // 2]
+    p95 = result[int(len(result) * .95) - 1]
+    logging.info(f'router {load} latency: median {median * 1000:.2f}ms, '
+                 f'p95 {p95 * 1000:.2f}ms, max {result[-1] * 1000:.2f}ms')
+
+    assert median < .05, f'router dispatch is too slow for {load} load: {median}'
@@ -1,5 +1,8 @@
+import fcntl
 import logging
+import multiprocessing as mp
 import os
+import threading
 import time
 
 import pytest
@@ -7,8 +10,8 @@ import yaml
 
 from skabenclient.config import Config, DeviceConfig, FileLock, SystemConfig
 from skabenclient.helpers import Event
-from skabenclient.loaders import get_yaml_loader
-from skabenclient.tests.mock.data import base_config, yaml_content, yaml_content_as_dict
+from skabenclient.loaders import get_yaml_dumper, get_yaml_loader
+from skabenclient.tests.mock.data import base_config, make_assets, yaml_content, yaml_content_as_dict
 
 
 @pytest.fixture(autouse=True)
@@ -133,7 +136,7 @@ def test_config_system_init_base(get_config, default_config):
     """ Test creates SystemConfig """
     config = default_config('sys')
     cfg = get_config(SystemConfig, config)
-    test_keys = ['q_int', 'q_ext', 'q_log', 'ip', 'uid', 'sub', 'pub'] \
+    test_keys = ['q_int', 'q_ext', 'q_log', 'shared_state', 'ip', 'uid', 'sub', 'pub'] \
                 + list(config.keys())
     conf_keys = list(cfg.data.keys())
     test_keys.sort()
@@ -293,6 +296,111 @@ def test_config_device_load(get_config, config_dict):
     assert cfg.data == config_dict, 'data not loaded'
 
 
+def _age_file(path, seconds=60):
+    """move file modification time to the past"""
+    mtime = time.time() - seconds
+    os.utime(path, (mtime, mtime))
+
+
+def test_config_read_cache(get_config, monkeypatch):
+    """ Test unchanged config file is not parsed again """
+    cfg = get_config(Config, base_config)
+    _age_file(cfg.config_path)
+    first = cfg.read()
+    monkeypatch.setattr(cfg.storage, 'parse', lambda fh: pytest.fail('unchanged file parsed again'))
+    second = cfg.read()
+    second['int']['assume'].append('mutated')
+
+    assert first == base_config
+    assert cfg.read() == base_config, 'cache mutated by caller'
+
+
+def test_config_read_cache_invalidated(get_config, write_config_fixture):
+    """ Test same-size change of config file is detected """
+    cfg = get_config(Config, {'value': 1})
+    _age_file(cfg.config_path, 120)
+    assert cfg.read() == {'value': 1}
+
+    write_config_fixture({'value': 2}, os.path.basename(cfg.config_path))
+    _age_file(cfg.config_path)
+
+    assert cfg.read() == {'value': 2}, 'stale config returned from cache'
+
+
+def test_config_device_load_parse_once(get_config, monkeypatch):
+    """ Test DeviceConfig load parses file once """
+    cfg = get_config(DeviceConfig, base_config)
+    parsed = []
+    parse = cfg.storage.parse
+    monkeypatch.setattr(cfg.storage, 'parse', lambda fh: parsed.append(fh) or parse(fh))
+    cfg.load()
+
+    assert len(parsed) == 1, f'config parsed {len(parsed)} times'
+
+
+def test_config_device_load_benchmark(get_config):
+    """ Benchmark DeviceConfig load on config with many assets """
+    cfg = get_config(DeviceConfig, {**base_config, 'assets': make_assets(500)})
+    _age_file(cfg.config_path)
+    rounds = 10
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        cfg.storage._read_cache = None
+        cfg.load()
+    cold = (time.perf_counter() - start) / rounds
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        cfg.load()
+    cached = (time.perf_counter() - start) / rounds
+
+    logging.info(f'config load with 500 assets: {cold * 1000:.2f}ms parsed, {cached * 1000:.2f}ms cached')
+    assert cfg.data['assets'] == make_assets(500)
+    assert cached < cold, 'cached load should be faster than parsing'
+
+
+def test_config_device_write_behind(get_config):
+    """ Test DeviceConfig coalesces saves in write-behind mode """
+    cfg = get_config(DeviceConfig, base_config)
+    cfg.write_behind = 60
+    for idx in range(100):
+        cfg.save({'slider': idx})
+
+    assert cfg.flush_stats == {'saves': 100, 'flushes': 0}
+    assert cfg.dirty == {'slider'}
+    assert 'slider' not in cfg.read(), 'saved before flush'
+
+    cfg.flush()
+
+    assert cfg.flush_stats == {'saves': 100, 'flushes': 1}
+    assert not cfg.dirty
+    assert cfg.read() == {**base_config, 'slider': 99}, 'pending changes not flushed'
+
+
+def test_config_device_write_behind_interval(get_config):
+    """ Test DeviceConfig flushes pending saves after write-behind window """
+    cfg = get_config(DeviceConfig, base_config)
+    cfg.write_behind = .05
+    cfg.save({'slider': 1})
+    cfg.save({'slider': 2})
+    time.sleep(.3)
+
+    assert cfg.flush_stats['flushes'] == 1
+    assert cfg.read().get('slider') == 2
+
+
+def test_config_device_write_behind_load(get_config):
+    """ Test DeviceConfig reload does not lose pending saves """
+    cfg = get_config(DeviceConfig, base_config)
+    cfg.write_behind = 60
+    cfg.save({'slider': 1})
+    loaded = cfg.load()
+
+    assert cfg.flush_stats['flushes'] == 1, 'pending changes not flushed on reload'
+    assert loaded == {**base_config, 'slider': 1}
+
+
 def test_config_device_reset(get_config, monkeypatch):
     """ Test DeviceConfig reset to default parameters """
     monkeypatch.setattr(DeviceConfig, 'minimal_essential_conf', {'test': 'conf'})
@@ -350,6 +458,18 @@ def test_config_device_restore_missing(get_config, config_dict, monkeypatch, wri
     assert should_be_default == is_default, 'configs not matched'
 
 
+def _is_locked(path, operation=fcntl.LOCK_EX):
+    """try to lock file from separate descriptor"""
+    fd = os.open(path, os.O_RDWR | os.O_CREAT)
+    try:
+        fcntl.flock(fd, operation | fcntl.LOCK_NB)
+        return False
+    except BlockingIOError:
+        return True
+    finally:
+        os.close(fd)
+
+
 @pytest.mark.parametrize('config_dict', (base_config,))
 def test_file_lock_context(get_config, config_dict):
     """ Test FileLock release """
@@ -357,18 +477,32 @@ def test_file_lock_context(get_config, config_dict):
     file_lock = FileLock(cfg.config_path)
     # acquire lock context
     with file_lock:
-        with open(file_lock.lock_path) as fh:
-            content = fh.read().strip()
-    # lock released, check lockfile content
-    with open(file_lock.lock_path) as fh:
-        no_lock_content = fh.read().strip()
-
-    assert content == '1', 'value not written to lockfile'
-    assert no_lock_content == '0', 'value not released'
-    assert file_lock.locked is None, "not released"    
+        locked = _is_locked(file_lock.lock_path)
+    # lock released
+    no_lock = _is_locked(file_lock.lock_path)
+
+    assert locked, 'lock not acquired'
+    assert not no_lock, 'lock not released'
+    assert file_lock.locked is None, "not released"
     assert file_lock.lock_path == f"{cfg.config_path}.lock"
 
 
+@pytest.mark.parametrize('config_dict', (base_config,))
+def test_file_lock_shared(get_config, config_dict):
+    """ Test FileLock shared lock allows readers and blocks writers """
+    cfg = get_config(DeviceConfig, config_dict.get('str'))
+
+    with FileLock(cfg.config_path, shared=True) as file_lock:
+        shared = _is_locked(file_lock.lock_path, fcntl.LOCK_SH)
+        exclusive = _is_locked(file_lock.lock_path)
+        assert cfg.read() == config_dict.get('str'), 'reader blocked by shared lock'
+        with pytest.raises(Exception):
+            FileLock(cfg.config_path, timeout=.05).acquire()
+
+    assert not shared, 'shared lock blocks readers'
+    assert exclusive, 'shared lock does not block writers'
+
+
 @pytest.mark.parametrize('config_dict', (base_config,))
 def test_file_lock_busy(get_config, monkeypatch, config_dict):
     """ Test FileLock when file locked """
@@ -383,3 +517,110 @@ def test_file_lock_busy(get_config, monkeypatch, config_dict):
             assert cfg.read()
 
     # assert res == None, 'lock acquired but should not'
+
+
+@pytest.mark.parametrize('config_dict', (base_config,))
+def test_file_lock_blocking(get_config, config_dict):
+    """ Test FileLock without timeout waits for busy lock in blocking flock """
+    cfg = get_config(DeviceConfig, config_dict.get('str'))
+    holder = FileLock(cfg.config_path)
+    holder.acquire()
+    timer = threading.Timer(.2, holder.release)
+    timer.start()
+
+    start = time.monotonic()
+    with FileLock(cfg.config_path, timeout=None) as file_lock:
+        waited = time.monotonic() - start
+        assert file_lock.locked
+    timer.join()
+
+    assert waited >= .15, 'busy lock acquired'
+
+
+@pytest.mark.parametrize('config_dict', (base_config,))
+def test_file_lock_error_closes_fd(get_config, monkeypatch, config_dict):
+    """ Test lock file descriptor is closed when flock fails """
+    cfg = get_config(DeviceConfig, config_dict.get('str'))
+    opened = len(os.listdir('/proc/self/fd'))
+
+    def _flock(fd, operation):
+        raise OSError('flock not supported')
+
+    monkeypatch.setattr(fcntl, 'flock', _flock)
+    for timeout in (None, 1):
+        with pytest.raises(OSError):
+            FileLock(cfg.config_path, timeout=timeout).acquire()
+
+    assert len(os.listdir('/proc/self/fd')) == opened, 'lock file descriptor leaked'
+
+
+def _config_worker(path, cycles, results):
+    errors = 0
+    cfg = Config(path)
+    for idx in range(cycles):
+        try:
+            cfg.read()
+            cfg.write({**base_config, 'counter': idx})
+        except Exception:
+            errors += 1
+    results.put(errors)
+
+
+@pytest.mark.parametrize('workers', (1, 4))
+def test_file_lock_contention_benchmark(get_config, workers):
+    """ Benchmark config read/write cycles from several processes sharing one config file """
+    cycles = 50
+    cfg = get_config(Config, base_config, fname='contended.yml')
+    results = mp.Queue()
+    processes = [mp.Process(target=_config_worker, args=(cfg.config_path, cycles, results))
+                 for _ in range(workers)]
+
+    start = time.perf_counter()
+    for process in processes:
+        process.start()
+    errors = sum(results.get(timeout=60) for _ in processes)
+    for process in processes:
+        process.join()
+    duration = time.perf_counter() - start
+
+    logging.info(f'{workers} processes: {workers * cycles} read/write cycles in {duration:.3f}s, '
+                 f'{duration / cycles * 1000:.2f}ms per cycle per process')
+
+    assert errors == 0, 'config read or write failed under contention'
+    assert {k: v for k, v in cfg.read().items() if k != 'counter'} == base_config, 'config corrupted'
+
+
+def test_yaml_libyaml_fallback(monkeypatch):
+    """ Test yaml loader and dumper fall back to pure python implementation """
+    monkeypatch.setattr(yaml, '__with_libyaml__', False)
+
+    assert not issubclass(get_yaml_loader(), yaml.CSafeLoader)
+    assert not issubclass(get_yaml_dumper(), yaml.CSafeDumper)
+    dump = yaml.dump(base_config, Dumper=get_yaml_dumper())
+    assert yaml.load(dump, Loader=get_yaml_loader()) == base_config
+
+
+@pytest.mark.skipif(not yaml.__with_libyaml__, reason='libyaml is not available')
+@pytest.mark.parametrize('name, content', (('yaml_content', yaml_content_as_dict),
+                                           ('base_config', base_config),
+                                           ('assets', {'assets': make_assets(200)})))
+def test_yaml_libyaml_benchmark(name, content):
+    """ Benchmark parse and dump of fixture configs with pure python and libyaml implementations """
+    rounds = 20
+    timings = {}
+    for libyaml in (False, True):
+        loader, dumper = get_yaml_loader(libyaml), get_yaml_dumper(libyaml)
+        start = time.perf_counter()
+        for _ in range(rounds):
+            dump = yaml.dump(content, Dumper=dumper, default_flow_style=False)
+        dumped = time.perf_counter() - start
+        start = time.perf_counter()
+        for _ in range(rounds):
+            loaded = yaml.load(dump, Loader=loader)
+        parsed = time.perf_counter() - start
+        assert loaded == content, 'round trip failed'
+        timings[libyaml] = (parsed / rounds, dumped / rounds)
+
+    logging.info(f'{name}: parse {timings[False][0] * 1000:.3f}ms -> {timings[True][0] * 1000:.3f}ms, '
+                 f'dump {timings[False][1] * 1000:.3f}ms -> {timings[True][1] * 1000:.3f}ms')
+    assert sum(timings[True]) < sum(timings[False]), 'libyaml should be faster'
@@ -1,3 +1,6 @@
+import json
+import logging
+import os
 import time
 
 import pytest
@@ -5,8 +8,8 @@ import pytest
 import skabenclient.contexts as mgr
 from skabenclient.config import DeviceConfig, SystemConfig
 from skabenclient.device import BaseDevice
-from skabenclient.helpers import make_event
-from skabenclient.tests.mock.comms import MockMessage
+from skabenclient.helpers import TimestampStore, make_event
+from skabenclient.tests.mock.comms import MockMessage, MockQueue
 from skabenclient.tests.mock.data import base_config, yaml_content_as_dict
 
 
@@ -126,6 +129,22 @@ def test_event_context_send_config(event_setup, monkeypatch, default_config):
     assert message.decoded['datahold'].get('new_value') == _dict.get('new_value'), f'bad data send: {message.decoded}'
 
 
+def test_event_context_send_config_compressed(event_setup, monkeypatch, default_config):
+    """ Test large config is sent with compressed datahold """
+    in_queue = list()
+    syscfg = event_setup(sys_config={**default_config('sys'), 'packet_compression': 'zlib', 'compress_threshold': 256})
+    _dict = {f'key_{idx}': 'value' * 10 for idx in range(100)}
+
+    with mgr.EventContext(syscfg) as context:
+        monkeypatch.setattr(context.q_ext, 'put', lambda x: in_queue.append(x))
+        context.send_config(_dict)
+        message = MockMessage(in_queue[-1])
+
+    assert b'"compression": "zlib"' in message.payload
+    assert len(message.payload) < len(json.dumps(_dict))
+    assert message.decoded['datahold'] == _dict
+
+
 def test_event_context_send_config_filtered(event_setup, monkeypatch, default_config):
     """ Test send config to server """
     syscfg = event_setup()
@@ -202,8 +221,94 @@ def test_event_context_confirm_update_ack(event_setup, default_config, monkeypat
     with mgr.EventContext(syscfg) as context:
         in_queue = list()
         monkeypatch.setattr(context.q_ext, 'put', lambda x: in_queue.append(x))
-        context.confirm_update(packet_type=cmd, task_id=_task_id)
+        packet = context.confirm_update(packet_type=cmd, task_id=_task_id)
         message = MockMessage(in_queue[-1])
 
         assert message.topic.split('/')[-1] == cmd
         assert message.decoded.get('task_id') == _task_id
+        assert isinstance(packet, getattr(mgr.sp, cmd.upper()))
+        assert packet.encode() == in_queue[-1]
+
+
+def test_event_context_reused_timestamp(event_setup, tmp_path):
+    """ Test long-lived context keeps timestamp in memory between events """
+    syscfg = event_setup()
+    syscfg.root = str(tmp_path)
+    ping = {'command': 'ping', 'timestamp': 100, 'datahold': {}}
+
+    with mgr.EventContext(syscfg) as context:
+        context.q_ext = MockQueue()
+        context.absorb(make_event('mqtt', 'new', ping))
+        context.absorb(make_event('mqtt', 'new', {**ping, 'timestamp': 50}))
+        pong = MockMessage(context.q_ext.get())
+
+    assert context.timestamp == 100, 'timestamp not kept between events'
+    assert len(context.q_ext.data) == 0, 'message from the past was not ignored'
+    assert pong.decoded.get('timestamp') == 100, 'PONG should send timestamp of PING'
+
+
+def test_event_context_dispatch_benchmark(event_setup, monkeypatch):
+    """ Benchmark per-event dispatch cost with context per event and with reused context """
+    syscfg = event_setup()
+    monkeypatch.setattr(mgr.EventContext, 'manage', lambda *args: None)
+    events = [make_event('device', 'input', {'value': idx}) for idx in range(500)]
+
+    start = time.perf_counter()
+    for event in events:
+        with mgr.EventContext(syscfg) as context:
+            context.absorb(event)
+    per_event = (time.perf_counter() - start) / len(events)
+
+    start = time.perf_counter()
+    with mgr.EventContext(syscfg) as context:
+        for event in events:
+            context.absorb(event)
+    reused = (time.perf_counter() - start) / len(events)
+
+    logging.info(f'event dispatch: {per_event * 1e6:.1f}us with new context, {reused * 1e6:.1f}us reused')
+    assert reused < per_event, 'reused context should be cheaper than context per event'
+
+
+def test_timestamp_store_coalesced(tmp_path):
+    """ Test timestamp writes are coalesced until flush """
+    path = str(tmp_path / 'timestamp')
+    store = TimestampStore(path, flush_interval=60)
+    for ts in range(1, 101):
+        store.set(ts)
+
+    assert store.value == 100
+    assert store.writes == 0, 'timestamp written before flush interval'
+    assert not os.path.exists(path)
+
+    store.close()
+
+    assert store.writes == 1
+    assert TimestampStore(path).value == 100, 'timestamp not persisted on close'
+
+
+def test_timestamp_store_interval(tmp_path):
+    """ Test pending timestamp is written after flush interval """
+    path = str(tmp_path / 'timestamp')
+    store = TimestampStore(path, flush_interval=.05)
+    store.set(42)
+    time.sleep(.3)
+
+    assert store.writes == 1
+    assert store.load() == 42
+
+
+def test_timestamp_store_atomic(tmp_path, monkeypatch):
+    """ Test interrupted write leaves previous value intact """
+    path = str(tmp_path / 'timestamp')
+    store = TimestampStore(path)
+    store.set(10)
+
+    def _power_cut(*args):
+        raise OSError('power cut')
+
+    monkeypatch.setattr(os, 'replace', _power_cut)
+    with pytest.raises(OSError):
+        store.set(20)
+
+    assert os.listdir(str(tmp_path)) == ['timestamp'], 'temporary file left behind'
+    assert store.load() == 10, 'timestamp file corrupted'
@@ -1,8 +1,18 @@
+import json
+import logging
+import queue
+import threading
+import time
+
 import pytest
 
-from skabenclient.config import SystemConfig
+from skabenclient.config import DeviceConfig, SystemConfig
+from skabenclient.contexts import EventContext, Router
+from skabenclient.device import BaseDevice
+from skabenclient.helpers import make_event
 from skabenclient.mqtt_client import MQTTClient
-from skabenclient.tests.mock.comms import MockMessage, MockQueue
+from skabenclient.serializers import msgpack
+from skabenclient.tests.mock.comms import MockBroker, MockMessage, MockQueue
 
 test_message_content = (
     "topic/uid/command",
@@ -52,4 +62,226 @@ def test_client_on_message(get_client, monkeypatch):
     assert isinstance(data.get('datahold'), dict)
     assert data.get('datahold') == {'test': 'data'}
 
+
+@pytest.mark.skipif(not msgpack, reason='msgpack is not installed')
+def test_client_on_message_msgpack(get_client):
+    """ Test MessagePack payload is detected and decoded """
+    client, config = get_client
+    client.q_int = MockQueue()
+    payload = msgpack.packb({'task_id': '12345', 'timestamp': 987654321, 'datahold': {'test': 'data'}})
+    client.on_message(client='', userdata='', msg=MockMessage(('topic/uid/sup', payload)))
+    data = client.q_int.get().data
+
+    assert data['timestamp'] == 987654321
+    assert data['datahold'] == {'test': 'data'}
+
+
+def test_client_publisher_drain(get_client):
+    """publisher sends all queued packets in one pass and stops by exit message"""
+    client, config = get_client
+    client.client = MockBroker()
+    client.running = True
+    packets = [(f'ask/test/{idx}', b'{}') for idx in range(5)]
+    for packet in packets:
+        client.q_ext.put(packet)
+    client.q_ext.put(('exit', 'exit'))
+    time.sleep(.1)
+
+    assert len(client.drain_queue()) == len(packets) + 1
+    for packet in packets:
+        client.q_ext.put(packet)
+    client.q_ext.put(('exit', 'exit'))
+    client.publisher()
+
+    assert [(topic, payload) for _, topic, payload in client.client.published] == packets
+    assert client.running is False
+
+
+def test_client_publisher_stop_on_disconnect(get_client):
+    """idle publisher exits on clean disconnect and run() disconnects client"""
+    client, config = get_client
+    client.client = MockBroker()
+    client.running = True
+    publisher = threading.Thread(target=client.publisher, daemon=True)
+    publisher.start()
+    time.sleep(.1)
+
+    client.on_disconnect(client.client, None, 0)
+    publisher.join(1)
+
+    assert not publisher.is_alive(), 'publisher still waits for external queue'
+    assert client.running is False
+
+
+@pytest.mark.parametrize('burst_size, bursts', ((1, 200), (200, 5)))
+def test_client_publisher_benchmark(get_client, burst_size, bursts):
+    """Benchmark enqueue-to-publish latency and outbound throughput"""
+    client, config = get_client
+    client.client = MockBroker()
+    client.running = True
+    publisher = threading.Thread(target=client.publisher, daemon=True)
+    publisher.start()
+
+    for _ in range(bursts):
+        for _ in range(burst_size):
+            payload = json.dumps({'sent': time.perf_counter()}).encode('utf-8')
+            client.q_ext.put(('ask/test/pong', payload))
+        time.sleep(.005)
+    client.q_ext.put(('exit', 'exit'))
+    publisher.join(10)
+
+    published = client.client.published
+    latency = sorted(received - json.loads(payload)['sent'] for received, _, payload in published)
+    median = latency[len(latency) // 2]
+    duration = published[-1][0] - json.loads(published[0][2])['sent']
+    logging.info(f'publisher {burst_size}x{bursts}: median latency {median * 1000:.2f}ms, '
+                 f'max {latency[-1] * 1000:.2f}ms, throughput {len(published) / duration:.0f} msg/s')
+
+    assert len(published) == burst_size * bursts, 'not all messages published'
+    assert median < .05, f'publisher is too slow: {median}'
+
+
+def test_client_routes(get_client):
+    """subscribed topics are resolved by precompiled route table"""
+    client, config = get_client
+    topic, uid = config.get('topic'), config.get('uid')
+
+    assert client.routes == {f'{topic}/all': (topic, 'all'), f'{topic}/{uid}': (topic, uid)}
+    assert MQTTClient.compile_routes(['dev/+/#', 'dev/#', 'dev/cmd']) == {'dev': ('dev', None),
+                                                                         'dev/cmd': ('dev', 'cmd')}
+    with pytest.raises(Exception):
+        MQTTClient.parse_topic('dev/uid/extra')
+
+
+@pytest.mark.parametrize('topic', ('{topic}/all/ping', '{topic}/{uid}/ping', 'other/uid/ping', 'other/ping'))
+def test_client_on_message_routed(get_client, topic):
+    client, config = get_client
+    client.q_int = MockQueue()
+    topic = topic.format(topic=config.get('topic'), uid=config.get('uid'))
+    client.on_message(client='', userdata='', msg=MockMessage((topic, b'{"timestamp": 1}')))
+    data = client.q_int.get().data
+    parts = topic.split('/')
+
+    assert (data['topic'], data['uid'], data['command']) == (parts[0], parts[1] if len(parts) == 3 else None, 'ping')
+
+
+def test_client_inbound_benchmark(get_config, default_config, tmp_path):
+    """Benchmark inbound messages per second from on_message to context command handler"""
+    devcfg = get_config(DeviceConfig, default_config('dev'), fname='test_cfg.yml')
+    syscfg = get_config(SystemConfig, default_config('sys'))
+    syscfg.root = str(tmp_path)
+    syscfg.data.update(q_int=queue.SimpleQueue(), q_ext=queue.SimpleQueue())
+    syscfg.set('device', BaseDevice(syscfg, devcfg))
+    client = MQTTClient(syscfg)
+    client.q_int = queue.SimpleQueue()  # events from context are kept apart
+    prefix = f"{syscfg.get('topic')}/{syscfg.get('uid')}"
+    number = 2000
+
+    results = {}
+    for run, (name, routes) in enumerate((('precompiled', client.routes), ('split', {}))):
+        messages = []
+        for idx in range(number):
+            command = ('ping', 'cup', 'sup', 'info')[idx % 4]
+            payload = {'timestamp': (run + 1) * number + idx, 'task_id': str(idx), 'datahold': {'idx': idx}}
+            messages.append(MockMessage((f'{prefix}/{command}', json.dumps(payload).encode('utf-8'))))
+        client.routes = routes
+        with EventContext(syscfg) as context:
+            start = time.perf_counter()
+            for message in messages:
+                client.on_message(client='', userdata='', msg=message)
+                context.absorb(client.q_int.get_nowait())
+            results[name] = number / (time.perf_counter() - start)
+        forwarded = [syscfg.get('q_int').get_nowait().cmd for _ in range(syscfg.get('q_int').qsize())]
+        pongs = [syscfg.get('q_ext').get_nowait() for _ in range(syscfg.get('q_ext').qsize())]
+
+        assert sorted(set(forwarded)) == ['info', 'sup', 'update'] and len(forwarded) == number * 3 // 4
+        assert len(pongs) == number // 4
+    logging.info(f"inbound: {results['precompiled']:.0f} msg/s with route table, {results['split']:.0f} msg/s with split")
+
+
+def ping_message(config, timestamp):
+    topic = f"{config.get('topic')}/{config.get('uid')}/ping"
+    return MockMessage((topic, json.dumps({'timestamp': timestamp}).encode('utf-8')))
+
+
+@pytest.mark.parametrize('fast_ping', (True, False))
+def test_client_fast_ping(get_client, fast_ping):
+    """PING is answered by MQTT process from shared state, router is informed"""
+    client, config = get_client
+    client.fast_ping = fast_ping
+    client.client = MockBroker()
+    client.q_int = MockQueue()
+    config.get('shared_state').update(timestamp=100, config_hash='abc')
+
+    client.on_message(client='', userdata='', msg=ping_message(config, 200))
+    client.on_message(client='', userdata='', msg=ping_message(config, 150))
+    past, current = client.q_int.get(), client.q_int.get()
+
+    assert current.data['replied'] is fast_ping
+    assert past.data['replied'] is False, 'PING from the past answered'
+    if fast_ping:
+        (_, topic, payload), = client.client.published
+        assert topic == f"{config.get('pub')}/{config.get('uid')}/pong"
+        assert json.loads(payload) == {'timestamp': 200, 'hash': 'abc'}
+        assert config.get('shared_state').snapshot() == (200, 'abc')
+        assert client.pong_stats == {'fast': 1, 'forwarded': 1}
+    else:
+        assert client.client.published == []
+        assert client.pong_stats == {'fast': 0, 'forwarded': 2}
+
+
+def test_context_fast_ping(get_config, default_config, tmp_path):
+    """context keeps shared state and does not answer PING replied by MQTT process"""
+    devcfg = get_config(DeviceConfig, {**default_config('dev'), 'hash': 'cfghash'}, fname='test_cfg.yml')
+    syscfg = get_config(SystemConfig, default_config('sys'))
+    syscfg.root = str(tmp_path)
+    syscfg.data.update(q_ext=queue.SimpleQueue())
+    syscfg.set('device', BaseDevice(syscfg, devcfg))
+    shared = syscfg.get('shared_state')
+
+    with EventContext(syscfg) as context:
+        assert shared.snapshot() == (0, 'cfghash')
+        context.absorb(make_event('mqtt', 'new', {'command': 'ping', 'timestamp': 300, 'replied': True}))
+        assert context.q_ext.empty()
+        assert context.timestamp == 300
+        context.absorb(make_event('mqtt', 'new', {'command': 'wait', 'timestamp': 300, 'datahold': {'timeout': 5}}))
+        assert shared.snapshot() == (305, 'cfghash')
+
+
+@pytest.mark.parametrize('fast_ping', (False, True))
+def test_client_ping_rtt_benchmark(get_config, default_config, tmp_path, fast_ping):
+    """Benchmark PING to PONG time inside client, through router and with fast path"""
+    devcfg = get_config(DeviceConfig, default_config('dev'), fname='test_cfg.yml')
+    syscfg = get_config(SystemConfig, {**default_config('sys'), 'fast_ping': fast_ping})
+    syscfg.root = str(tmp_path)
+    syscfg.set('device', BaseDevice(syscfg, devcfg))
+    client = MQTTClient(syscfg)
+    client.client = MockBroker()
+    client.running = True
+    router = Router(syscfg)
+    router.start()
+    publisher = threading.Thread(target=client.publisher, daemon=True)
+    publisher.start()
+
+    rtt = []
+    for idx in range(100):
+        sent = time.perf_counter()
+        client.on_message(client='', userdata='', msg=ping_message(syscfg, 1000 + idx))
+        while len(client.client.published) <= idx and time.perf_counter() - sent < 5:
+            time.sleep(.0001)
+        rtt.append(client.client.published[idx][0] - sent)
+        time.sleep(.002)
+    syscfg.get('q_int').put(make_event('exit'))
+    publisher.join(5)
+    router.join(5)
+
+    rtt.sort()
+    median = rtt[len(rtt) // 2]
+    logging.info(f"ping rtt {'fast path' if fast_ping else 'router'}: median {median * 1e6:.0f}us, "
+                 f"p95 {rtt[94] * 1e6:.0f}us, max {rtt[-1] * 1e6:.0f}us")
+    assert [json.loads(payload)['timestamp'] for _, _, payload in client.client.published[:100]] == \
+        list(range(1000, 1100))
+    assert client.pong_stats['fast'] == (100 if fast_ping else 0)
+
+
 # holy molly I don't want to test paho mqtt connect/reconnect...
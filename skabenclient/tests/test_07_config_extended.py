@@ -1,9 +1,16 @@
+import hashlib
+import json
+import logging
 import os
+import queue
 import shutil
+import time
 
 import pytest
 
 from skabenclient.config import DeviceConfig, DeviceConfigExtended, SystemConfig
+from skabenclient.loaders import HTTPLoader
+from skabenclient.tests.mock.server import AssetServer
 
 REMOTE_DIR = os.path.join(os.path.dirname(__file__), "res")
 LOCAL_DIR = os.path.join(os.path.dirname(__file__), "temp")
@@ -57,6 +64,7 @@ def get_extended_config(monkeypatch, get_config, default_config, asset_root):
     dev_config_base = get_config(DeviceConfig, default_config('dev'))  # create for config path
     # get extended from config path, make assets subdirectories on init
     monkeypatch.setattr(DeviceConfigExtended, 'asset_paths', ASSET_PATHS)
+    monkeypatch.setattr(DeviceConfigExtended, 'files_local', {})
     dev_config = DeviceConfigExtended(dev_config_base.config_path, system_config)
     return dev_config
 
@@ -175,3 +183,690 @@ def gen_file_data(name, url, path, hash=None):
         "local_path": os.path.join(ASSETS_ROOT, path),
         "hash": hash if hash else name
     }
+
+
+@pytest.fixture
+def asset_server(tmp_path, request):
+    """local asset server with many small and a few large files"""
+
+    def _wrap(small=20, large=2, large_size=128 * 1024, delay=.05):
+        files = {}
+        for file_type, prefix, number, size in (('sound', 'small', small, 2048),
+                                                ('another', 'large', large, large_size)):
+            os.makedirs(tmp_path / file_type, exist_ok=True)
+            for idx in range(number):
+                fname = f'{prefix}_{idx}.bin'
+                (tmp_path / file_type / fname).write_bytes(os.urandom(size))
+                files[f'{prefix}{idx:04d}'] = f'{file_type}/{fname}'
+        server = AssetServer(str(tmp_path), delay=delay).start()
+        request.addfinalizer(server.stop)
+        request.addfinalizer(HTTPLoader.close_sessions)
+        return server, {_hash: f'{server.url}/{path}' for _hash, path in files.items()}, tmp_path
+
+    return _wrap
+
+
+def test_download_report(get_extended_config, asset_server):
+    """test concurrent download loads files and reports failures"""
+    server, files, remote_dir = asset_server(small=5, large=1)
+    files['missing'] = f'{server.url}/sound/missing.bin'
+    dev_config = get_extended_config
+    dev_config.make_asset_paths()
+    to_load = dev_config.parse_files(files)
+
+    dev_config.get_files_async(list(to_load.values()))
+    report = dev_config.download_report
+
+    assert list(report['failed']) == ['missing']
+    assert set(report['loaded']) == set(files) - {'missing'}
+    for _hash, path in report['loaded'].items():
+        remote_path = remote_dir / '/'.join(files[_hash].split('/')[-2:])
+        assert read_bin(path) == read_bin(remote_path), f'{path} content mismatch'
+        assert dev_config.files_local.get(_hash)
+
+
+def test_download_benchmark(get_extended_config, asset_server):
+    """benchmark download of many small and a few large assets, serial and concurrent"""
+    server, files, remote_dir = asset_server()
+    dev_config = get_extended_config
+    dev_config.make_asset_paths()
+    to_load = list(dev_config.parse_files(files).values())
+
+    timings = {}
+    for max_workers in (1, 4):
+        dev_config.system.data['max_workers'] = max_workers
+        start = time.perf_counter()
+        dev_config.get_files_async(to_load)
+        timings[max_workers] = time.perf_counter() - start
+        assert len(dev_config.download_report['loaded']) == len(files)
+
+    logging.info(f'{len(to_load)} assets: {timings[1]:.3f}s serial, {timings[4]:.3f}s with 4 workers')
+    assert timings[4] < timings[1], 'concurrent download is not faster than serial'
+
+
+def test_download_bandwidth_limit(get_extended_config, asset_server):
+    """test total download throughput is bound by max_bandwidth"""
+    server, files, remote_dir = asset_server(small=0, large=4, large_size=64 * 1024, delay=0)
+    rate = 128 * 1024
+    dev_config = get_extended_config
+    dev_config.system.data['max_bandwidth'] = rate
+    dev_config.system.data['max_workers'] = 4
+    dev_config.make_asset_paths()
+
+    start = time.perf_counter()
+    dev_config.get_files_async(list(dev_config.parse_files(files).values()))
+    duration = time.perf_counter() - start
+
+    total = 4 * 64 * 1024
+    assert len(dev_config.download_report['loaded']) == len(files)
+    assert duration >= (total - rate) / rate * .9, f'bandwidth not limited: {total / duration:.0f}B/s'
+
+
+@pytest.mark.parametrize('keepalive', (True, False))
+def test_download_connection_reuse(get_extended_config, asset_server, keepalive):
+    """test connections are reused across files and across syncs"""
+    server, files, remote_dir = asset_server(large=0, delay=0)
+    dev_config = get_extended_config
+    dev_config.system.data.update(max_workers=2, http_keepalive=keepalive)
+    dev_config.make_asset_paths()
+    to_load = list(dev_config.parse_files(files).values())
+
+    dev_config.get_files_async(to_load)
+    first_sync = dev_config.http_stats()
+    dev_config.get_files_async(to_load)
+    second_sync = dev_config.http_stats()
+
+    assert first_sync['requests'] == len(files)
+    assert second_sync['requests'] == 2 * len(files)
+    if keepalive:
+        assert first_sync['new'] <= 2, f'connections not reused: {first_sync}'
+        assert second_sync['new'] == first_sync['new'], 'connections not reused between syncs'
+    else:
+        assert second_sync['reused'] == 0
+
+
+@pytest.fixture
+def stream_server(tmp_path, request):
+    """local asset server with single file of given size"""
+
+    def _wrap(size, sparse=False, ranges=True):
+        path = tmp_path / 'stream.bin'
+        with open(path, 'wb') as fh:
+            if sparse:
+                fh.truncate(size)
+            else:
+                fh.write(os.urandom(size))
+        server = AssetServer(str(tmp_path), ranges=ranges).start()
+        request.addfinalizer(server.stop)
+        request.addfinalizer(HTTPLoader.close_sessions)
+        return server, f'{server.url}/stream.bin', path
+
+    return _wrap
+
+
+@pytest.mark.parametrize('chunk_size, buffer_reuse', ((1024, False), (1024, True), (64 * 1024, True)))
+def test_download_stream(asset_root, stream_server, tmp_path, chunk_size, buffer_reuse):
+    """test file is streamed by chunks with and without buffer reuse"""
+    server, url, remote_path = stream_server(300 * 1024 + 7)
+    system_config = asset_root(None)
+    system_config.data.update(http_chunk_size=chunk_size, http_buffer_reuse=buffer_reuse)
+    loader = HTTPLoader(system_config)
+    local_path = str(tmp_path / 'loaded.bin')
+
+    assert loader.chunk_size == chunk_size
+    assert loader.get_file(url, local_path) == local_path
+    assert read_bin(local_path) == read_bin(remote_path)
+
+
+BENCH_SIZES = [1024 * 1024, 50 * 1024 * 1024]
+if os.environ.get('SKABEN_BENCH_LARGE'):
+    BENCH_SIZES.append(500 * 1024 * 1024)
+
+
+@pytest.mark.parametrize('size', BENCH_SIZES)
+def test_download_stream_benchmark(asset_root, stream_server, tmp_path, size):
+    """benchmark download throughput by chunk size, 500MB file enabled by SKABEN_BENCH_LARGE"""
+    server, url, remote_path = stream_server(size, sparse=True)
+    system_config = asset_root(None)
+    local_path = str(tmp_path / 'loaded.bin')
+    modes = [(64 * 1024, False), (64 * 1024, True), (1024 * 1024, True)]
+    if size <= 1024 * 1024:
+        modes.insert(0, (1, False))  # previous iter_content default
+
+    throughput = {}
+    for chunk_size, buffer_reuse in modes:
+        system_config.data.update(http_chunk_size=chunk_size, http_buffer_reuse=buffer_reuse)
+        start = time.perf_counter()
+        HTTPLoader(system_config).get_file(url, local_path)
+        duration = time.perf_counter() - start
+        assert os.path.getsize(local_path) == size
+        throughput[chunk_size, buffer_reuse] = size / duration / 1024 / 1024
+        logging.info(f'{size // 1024 // 1024}MB, chunk {chunk_size}B{" readinto" if buffer_reuse else ""}: '
+                     f'{throughput[chunk_size, buffer_reuse]:.1f}MB/s')
+
+    if (1, False) in throughput:
+        assert throughput[64 * 1024, False] > throughput[1, False] * 10, 'chunked download is not faster'
+
+
+@pytest.mark.parametrize('ranges', (True, False))
+def test_download_resume(asset_root, stream_server, tmp_path, ranges):
+    """test interrupted download is resumed from partial file or loaded again without range support"""
+    size, dropped = 256 * 1024, 100 * 1024
+    server, url, remote_path = stream_server(size, ranges=ranges)
+    loader = HTTPLoader(asset_root(None))
+    local_path = str(tmp_path / 'loaded.bin')
+    part_path = local_path + loader.part_suffix
+
+    server.drop_after(dropped)
+    with pytest.raises(Exception):
+        loader.get_file(url, local_path)
+    assert not os.path.exists(local_path), 'incomplete file moved to local path'
+    assert os.path.getsize(part_path) == dropped
+
+    assert loader.get_file(url, local_path) == local_path
+    assert read_bin(local_path) == read_bin(remote_path)
+    assert not os.path.exists(part_path)
+    assert server.range_requests == [('/stream.bin', f'bytes={dropped}-')]
+
+
+@pytest.mark.parametrize('etags', (True, False))
+def test_download_resume_changed(asset_root, stream_server, tmp_path, etags):
+    """test partial file is loaded again when remote file changed after interruption"""
+    size, dropped = 256 * 1024, 100 * 1024
+    server, url, remote_path = stream_server(size)
+    server.httpd.etags = etags
+    loader = HTTPLoader(asset_root(None))
+    local_path = str(tmp_path / 'loaded.bin')
+
+    server.drop_after(dropped)
+    with pytest.raises(Exception):
+        loader.get_file(url, local_path)
+    time.sleep(1)  # Last-Modified has one second resolution
+    remote_path.write_bytes(os.urandom(size))
+
+    loader.get_file(url, local_path)
+    assert server.range_requests == [('/stream.bin', f'bytes={dropped}-')], 'range request not sent'
+    assert hashlib.sha256(read_bin(local_path)).digest() == hashlib.sha256(read_bin(remote_path)).digest(), \
+        'stale partial file resumed'
+    assert loader.transfer['bytes'] == size
+    assert loader.transfer['resumed_from'] == 0
+
+
+def test_download_resume_unknown_part(asset_root, stream_server, tmp_path):
+    """test partial file left by another process is not resumed without validators"""
+    server, url, remote_path = stream_server(4096)
+    loader = HTTPLoader(asset_root(None))
+    local_path = str(tmp_path / 'loaded.bin')
+    with open(local_path + loader.part_suffix, 'wb') as fh:
+        fh.write(os.urandom(1024))
+
+    loader.get_file(url, local_path)
+    assert server.range_requests == []
+    assert read_bin(local_path) == read_bin(remote_path)
+
+
+def test_download_resume_stale_part(asset_root, stream_server, tmp_path):
+    """test partial file larger than remote file is loaded again"""
+    server, url, remote_path = stream_server(1024)
+    loader = HTTPLoader(asset_root(None))
+    local_path = str(tmp_path / 'loaded.bin')
+    with open(local_path + loader.part_suffix, 'wb') as fh:
+        fh.write(os.urandom(2048))
+
+    loader.get_file(url, local_path)
+    assert read_bin(local_path) == read_bin(remote_path)
+
+
+def test_download_resume_restart(asset_root, stream_server, tmp_path):
+    """test interrupted download is resumed by new loader after restart"""
+    size, dropped = 256 * 1024, 100 * 1024
+    server, url, remote_path = stream_server(size)
+    local_path = str(tmp_path / 'loaded.bin')
+    part_path = local_path + HTTPLoader.part_suffix
+
+    server.drop_after(dropped)
+    with pytest.raises(Exception):
+        HTTPLoader(asset_root(None)).get_file(url, local_path)
+    assert os.path.isfile(part_path + HTTPLoader.meta_suffix)
+    HTTPLoader.close_sessions()
+
+    loader = HTTPLoader(asset_root(None))
+    loader.get_file(url, local_path)
+    assert server.range_requests == [('/stream.bin', f'bytes={dropped}-')]
+    assert loader.transfer['resumed_from'] == dropped
+    assert read_bin(local_path) == read_bin(remote_path)
+    assert not os.path.exists(part_path + HTTPLoader.meta_suffix)
+
+
+def hash_files(files, remote_dir, algorithm='sha256'):
+    """rekey asset urls by content hash"""
+    result = {}
+    for url in files.values():
+        content = read_bin(remote_dir / '/'.join(url.split('/')[-2:]))
+        result[hashlib.new(algorithm, content).hexdigest()] = url
+    return result
+
+
+@pytest.mark.parametrize('algorithm', ('md5', 'sha1', 'sha256'))
+def test_download_verified(get_extended_config, asset_server, algorithm):
+    """test assets are verified by hash and stored once"""
+    server, files, remote_dir = asset_server(small=3, large=1, delay=0)
+    files = hash_files(files, remote_dir, algorithm)
+    dev_config = get_extended_config
+    dev_config.make_asset_paths()
+
+    dev_config.get_files_async(list(dev_config.parse_files(files).values()))
+
+    assert set(dev_config.download_report['loaded']) == set(files)
+    for _hash, path in dev_config.download_report['loaded'].items():
+        assert os.path.samefile(path, dev_config.store.path(_hash)), 'asset is not linked to store'
+
+
+def test_download_dedup(get_extended_config, asset_server):
+    """test content in store is linked to new path without download"""
+    server, files, remote_dir = asset_server(small=1, large=0, delay=0)
+    (_hash, url), = hash_files(files, remote_dir).items()
+    dev_config = get_extended_config
+    dev_config.make_asset_paths()
+    file_data = dev_config.parse_files({_hash: url})[_hash]
+
+    dev_config.fetch_file(file_data)
+    other_path = os.path.join(dev_config.asset_paths['another'], 'copy.bin')
+    dev_config.fetch_file({**file_data, 'local_path': other_path})
+
+    assert len(server.requests) == 1, 'same content loaded twice'
+    assert os.path.samefile(other_path, file_data['local_path'])
+
+
+def test_download_dedup_unverified(get_extended_config, asset_server):
+    """test identical content under different keys is stored once"""
+    server, files, remote_dir = asset_server(small=1, large=0, delay=0)
+    url = list(files.values())[0]
+    dev_config = get_extended_config
+    dev_config.make_asset_paths()
+    files = {'first': url, 'second': url.replace('small_0', 'copy_0')}
+    os.link(remote_dir / 'sound' / 'small_0.bin', remote_dir / 'sound' / 'copy_0.bin')
+
+    dev_config.get_files_async(list(dev_config.parse_files(files).values()))
+    report = dev_config.download_report['loaded']
+
+    assert os.path.samefile(report['first'], report['second'])
+    assert len([f for f in os.listdir(dev_config.store.root) if f != dev_config.store.incoming_dir]) == 1
+
+
+def test_download_corrupted(get_extended_config, asset_server):
+    """test corrupted asset is loaded again and reported failed after retries"""
+    server, files, remote_dir = asset_server(small=1, large=0, delay=0)
+    url = list(files.values())[0]
+    dev_config = get_extended_config
+    dev_config.system.data['verify_retries'] = 1
+    dev_config.make_asset_paths()
+    _hash = hashlib.sha256(b'expected content').hexdigest()
+
+    dev_config.get_files_async(list(dev_config.parse_files({_hash: url}).values()))
+
+    assert 'does not match' in dev_config.download_report['failed'][_hash]
+    assert len(server.requests) == 2
+    assert not os.path.exists(dev_config.parse_files({_hash: url})[_hash]['local_path'])
+    assert os.listdir(os.path.join(dev_config.store.root, dev_config.store.incoming_dir)) == []
+
+
+def test_download_resume_in_sync(get_extended_config, asset_server):
+    """test interrupted asset transfer is resumed within same sync"""
+    size, dropped = 128 * 1024, 32 * 1024
+    server, files, remote_dir = asset_server(small=0, large=1, large_size=size, delay=0)
+    files = hash_files(files, remote_dir)
+    (_hash, url), = files.items()
+    dev_config = get_extended_config
+    dev_config.make_asset_paths()
+
+    server.drop_after(dropped)
+    dev_config.get_files_async(list(dev_config.parse_files(files).values()))
+
+    assert set(dev_config.download_report['loaded']) == set(files)
+    assert server.range_requests == [('/another/large_0.bin', f'bytes={dropped}-')]
+    assert dev_config.download_report['summary']['bytes'] == size
+    assert os.listdir(os.path.join(dev_config.store.root, dev_config.store.incoming_dir)) == []
+
+
+def restart_config(dev_config):
+    """new config instance without loaded files in memory"""
+    restarted = DeviceConfigExtended(dev_config.config_path, dev_config.system)
+    restarted.files_local = {}
+    restarted.make_asset_paths()
+    return restarted
+
+
+def test_manifest_warm_restart(get_extended_config, asset_server):
+    """test loaded assets are not loaded again after restart unless changed on disk"""
+    server, files, remote_dir = asset_server(small=3, large=0, delay=0)
+    files = hash_files(files, remote_dir)
+    dev_config = get_extended_config
+    dev_config.make_asset_paths()
+    dev_config.get_files_async(list(dev_config.parse_files(files).values()))
+
+    restarted = restart_config(dev_config)
+    assert restarted.parse_files(files) == {}
+    assert set(restarted.files_local) == set(files)
+    assert set(files) <= set(restarted.get('assets'))
+
+    changed, changed_path = next(iter(dev_config.download_report['loaded'].items()))
+    os.remove(changed_path)
+    assert list(restart_config(dev_config).parse_files(files)) == [changed]
+
+
+def test_manifest_benchmark(get_extended_config, tmp_path):
+    """benchmark parse of large asset library after restart, with and without manifest"""
+    number = 2000
+    dev_config = get_extended_config
+    dev_config.make_asset_paths()
+    files = {f'{idx:032x}': f'http://127.0.0.1/sound/file_{idx}.ogg' for idx in range(number)}
+    for _hash, asset in dev_config.parse_files(files).items():
+        with open(asset['local_path'], 'wb') as fh:
+            fh.write(b'ogg')
+        dev_config.manifest.add(_hash, asset['local_path'])
+
+    timings = {}
+    for name, manifest_path in (('cold', str(tmp_path / 'empty.sqlite')), ('warm', dev_config.manifest.path)):
+        dev_config.system.data['asset_manifest'] = manifest_path
+        restarted = restart_config(dev_config)
+        start = time.perf_counter()
+        to_load = restarted.parse_files(files)
+        timings[name] = time.perf_counter() - start
+        assert len(to_load) == (number if name == 'cold' else 0)
+
+    logging.info(f'{number} assets after restart: {timings["cold"]:.3f}s without manifest, '
+                 f'{timings["warm"]:.3f}s with manifest')
+
+
+@pytest.mark.parametrize('etags', (True, False))
+def test_conditional_get_json(get_extended_config, tmp_path, request, etags):
+    """test unchanged JSON is served from validator cache, changed JSON is loaded again"""
+    (tmp_path / 'assets.json').write_text(json.dumps({'files': [1, 2]}))
+    server = AssetServer(str(tmp_path), etags=etags).start()
+    request.addfinalizer(server.stop)
+    request.addfinalizer(HTTPLoader.close_sessions)
+    url = f'{server.url}/assets.json'
+    dev_config = get_extended_config
+
+    first = dev_config.get_json(url)
+    first['files'].append('mutated')
+    assert dev_config.get_json(url) == {'files': [1, 2]}, 'cached body not served'
+    assert dev_config.http_stats()['cache'] == {'hits': 1, 'misses': 1, 'evictions': 0, 'size': 1}
+
+    time.sleep(1)  # Last-Modified has one second resolution
+    (tmp_path / 'assets.json').write_text(json.dumps({'files': [3]}))
+    assert dev_config.get_json(url) == {'files': [3]}
+    assert dev_config.http_stats()['cache']['misses'] == 2
+
+
+def test_conditional_get_json_lru(get_config, default_config, tmp_path, request):
+    """test validator cache keeps bounded number of least recently used responses"""
+    for idx in range(3):
+        (tmp_path / f'{idx}.json').write_text(json.dumps({'idx': idx}))
+    server = AssetServer(str(tmp_path)).start()
+    request.addfinalizer(server.stop)
+    request.addfinalizer(HTTPLoader.close_sessions)
+    loader = HTTPLoader(get_config(SystemConfig, {**default_config('sys'), 'http_cache_size': 2}))
+
+    for idx in (0, 1, 0, 2, 0):
+        assert loader.get_json(f'{server.url}/{idx}.json') == {'idx': idx}
+
+    assert list(loader.cache.entries) == [f'{server.url}/{idx}.json' for idx in (2, 0)]
+    assert loader.cache_stats() == {'hits': 2, 'misses': 3, 'evictions': 1, 'size': 2}
+
+
+def test_conditional_get_file(asset_root, stream_server, tmp_path):
+    """test existing file is not loaded again when not modified on server"""
+    server, url, remote_path = stream_server(64 * 1024)
+    loader = HTTPLoader(asset_root(None))
+    local_path = str(tmp_path / 'loaded.bin')
+
+    loader.get_file(url, local_path)
+    hasher = hashlib.sha256()
+    loader.get_file(url, local_path, hasher=hasher)
+
+    assert hasher.hexdigest() == hashlib.sha256(read_bin(remote_path)).hexdigest()
+    assert loader.cache_stats(loader.file_cache)['hits'] == 1
+    assert loader.cache_stats()['size'] == 0, 'file validators kept with JSON responses'
+    assert loader.connection_stats()['requests'] == 2
+
+    os.remove(local_path)
+    loader.get_file(url, local_path)
+    assert read_bin(local_path) == read_bin(remote_path), 'removed file is not loaded again'
+
+
+def test_conditional_get_files(get_extended_config, asset_server):
+    """test loaded assets are not transferred again on next sync, JSON responses stay cached"""
+    server, files, remote_dir = asset_server(small=4, large=0, delay=0)
+    (remote_dir / 'assets.json').write_text(json.dumps({'files': list(files)}))
+    dev_config = get_extended_config
+    dev_config.system.data['http_cache_size'] = 2
+    dev_config.make_asset_paths()
+    assert dev_config.get_json(f'{server.url}/assets.json') == {'files': list(files)}
+    to_load = list(dev_config.parse_files(files).values())
+
+    dev_config.get_files_async(to_load)
+    dev_config.files_local.clear()
+    dev_config.get_files_async(to_load)
+
+    assert set(dev_config.download_report['loaded']) == set(files)
+    assert dev_config.download_report['summary']['bytes'] == 0
+    stats = dev_config.http_stats()
+    assert stats['file_cache'] == {'hits': 4, 'misses': 4, 'evictions': 0, 'size': 4}
+    assert stats['cache'] == {'hits': 0, 'misses': 1, 'evictions': 0, 'size': 1}
+    for asset in to_load:
+        assert read_bin(asset['local_path']) == read_bin(remote_dir / asset['url'].split('/', 3)[-1])
+
+
+def test_files_parse_benchmark(get_extended_config):
+    """benchmark parse of server file list, time should grow linearly with number of assets"""
+    dev_config = get_extended_config
+    dev_config.make_asset_paths()
+
+    timings = {}
+    for number in (1000, 10000):
+        files = {f'{number}_{idx:08x}': f'http://127.0.0.1/sound/file_{idx}.ogg' for idx in range(number)}
+        dev_config.files_local = {}
+        start = time.perf_counter()
+        to_load = dev_config.parse_files(files)
+        timings[number] = time.perf_counter() - start
+        assert len(to_load) == number
+        assert all(_hash in dev_config.data['assets'] for _hash in files)
+        logging.info(f'parse {number} assets: {timings[number] * 1000:.1f}ms')
+
+    assert timings[10000] < timings[1000] * 30, 'parse time grows faster than linear'
+
+
+def test_files_parse_removed(get_extended_config):
+    """test assets missing in server file list are removed in the same update"""
+    dev_config = get_extended_config
+    dev_config.make_asset_paths()
+    files = {f'{idx:032x}': f'http://127.0.0.1/sound/file_{idx}.ogg' for idx in range(5)}
+    dev_config.parse_files(files)
+    for _hash in files:
+        dev_config.set_file_loaded(_hash)
+    dropped = list(files)[0]
+    files.pop(dropped)
+
+    updates = []
+    update = dev_config.update
+    dev_config.update = lambda payload: updates.append(payload) or update(payload)
+    assert dev_config.parse_files(files) == {}
+
+    assert len(updates) == 1
+    assert set(dev_config.get('assets')) == set(files)
+    assert dropped not in dev_config.files_local
+
+
+@pytest.fixture
+def loaded_assets(get_extended_config, asset_server):
+    """device config with assets loaded from local server"""
+
+    def _wrap(**kwargs):
+        server, files, remote_dir = asset_server(delay=0, **kwargs)
+        files = hash_files(files, remote_dir)
+        dev_config = get_extended_config
+        dev_config.make_asset_paths()
+        dev_config.get_files_async(list(dev_config.parse_files(files).values()))
+        assert set(dev_config.download_report['loaded']) == set(files)
+        return dev_config, dev_config.download_report['loaded']
+
+    return _wrap
+
+
+def stored_objects(dev_config):
+    return [f for f in os.listdir(dev_config.store.root) if f != dev_config.store.incoming_dir]
+
+
+def test_asset_gc_orphaned(loaded_assets):
+    """test files of assets dropped from server file list are removed with stored content"""
+    dev_config, loaded = loaded_assets(small=3, large=0)
+    orphan, orphan_path = next(iter(loaded.items()))
+    files = {_hash: asset['url'] for _hash, asset in dev_config.data['assets'].items() if _hash != orphan}
+    assert dev_config.parse_files(files) == {}
+
+    report = dev_config.collect_garbage()
+
+    assert report['orphaned'] == [orphan]
+    assert report['freed'] == 2048
+    assert not os.path.exists(orphan_path)
+    assert orphan not in stored_objects(dev_config)
+    assert orphan not in dev_config.manifest.entries()
+    assert len(stored_objects(dev_config)) == 2
+    for _hash, path in loaded.items():
+        assert os.path.exists(path) == (_hash != orphan)
+
+
+def test_asset_gc_untracked(loaded_assets):
+    """test files in asset directories not recorded in manifest are removed"""
+    dev_config, loaded = loaded_assets(small=2, large=0)
+    untracked = os.path.join(dev_config.asset_paths['sound'], 'stale.ogg')
+    with open(untracked, 'wb') as fh:
+        fh.write(os.urandom(1024))
+
+    report = dev_config.collect_garbage()
+
+    assert report['untracked'] == [untracked]
+    assert report['orphaned'] == report['evicted'] == []
+    assert report['freed'] == 1024
+    assert not os.path.exists(untracked)
+    assert all(os.path.exists(path) for path in loaded.values())
+
+
+def test_asset_gc_quota(loaded_assets):
+    """test least recently used assets are evicted over disk quota and loaded again on next sync after use"""
+    dev_config, loaded = loaded_assets(small=0, large=4, large_size=64 * 1024)
+    hashes = list(loaded)
+    for _hash in (hashes[2], hashes[0], hashes[3], hashes[1]):
+        time.sleep(.01)
+        dev_config.mark_asset_used(_hash)
+
+    report = dev_config.collect_garbage(quota=2 * 64 * 1024)
+
+    assert report['evicted'] == [hashes[2], hashes[0]]
+    assert report['freed'] == 2 * 64 * 1024
+    assert len(stored_objects(dev_config)) == 2
+    assert set(dev_config.files_local) == {hashes[3], hashes[1]}
+    files = {_hash: asset['url'] for _hash, asset in dev_config.data['assets'].items() if _hash in loaded}
+    assert dev_config.parse_files(files) == {}, 'evicted assets loaded again'
+    assert restart_config(dev_config).parse_files(files) == {}
+    assert dev_config.collect_garbage(quota=2 * 64 * 1024)['evicted'] == []
+
+    dev_config.mark_asset_used(hashes[0])
+    assert set(dev_config.parse_files(files)) == {hashes[0]}
+
+
+def test_asset_gc_background(loaded_assets):
+    """test garbage collection runs in background thread after sync when enabled"""
+    dev_config, loaded = loaded_assets(small=2, large=0)
+    orphan = next(iter(loaded))
+    dev_config.parse_files({_hash: asset['url'] for _hash, asset in dev_config.data['assets'].items()
+                            if _hash != orphan})
+
+    thread = dev_config.collect_garbage_async()
+    assert thread.daemon
+    thread.join(timeout=5)
+    assert dev_config.gc_report['orphaned'] == [orphan]
+
+    dev_config.system.data['asset_gc'] = True
+    dev_config.gc_report = {}
+    dev_config.get_files_async([])
+    for _ in range(50):
+        if dev_config.gc_report:
+            break
+        time.sleep(.1)
+    assert dev_config.gc_report == {'orphaned': [], 'evicted': [], 'untracked': [], 'freed': 0}
+
+
+def test_transfer_metrics(asset_root, stream_server, tmp_path):
+    """test loader collects metrics of single transfer"""
+    size, dropped = 128 * 1024, 32 * 1024
+    server, url, remote_path = stream_server(size)
+    loader = HTTPLoader(asset_root(None))
+    local_path = str(tmp_path / 'loaded.bin')
+
+    server.drop_after(dropped)
+    with pytest.raises(Exception):
+        loader.get_file(url, local_path)
+    assert loader.transfer['bytes'] == dropped
+
+    loader.get_file(url, local_path)
+    assert loader.transfer['bytes'] == size - dropped
+    assert loader.transfer['resumed_from'] == dropped
+    assert loader.transfer['duration'] > 0
+    assert loader.transfer['throughput'] == pytest.approx(loader.transfer['bytes'] / loader.transfer['duration'])
+
+    loader.get_file(url, local_path)
+    assert loader.transfer['not_modified']
+    assert loader.transfer['bytes'] == 0
+
+
+def test_download_sync_report(get_extended_config, asset_server):
+    """test sync metrics are aggregated in download report"""
+    server, files, remote_dir = asset_server(small=4, large=1, delay=0)
+    dev_config = get_extended_config
+    dev_config.make_asset_paths()
+
+    dev_config.get_files_async(list(dev_config.parse_files(files).values()))
+    report = dev_config.download_report
+
+    assert set(report['transfers']) == set(files)
+    assert report['transfers']['large0000']['bytes'] == 128 * 1024
+    assert report['summary']['files'] == report['summary']['transferred'] == len(files)
+    assert report['summary']['bytes'] == 4 * 2048 + 128 * 1024
+    assert report['summary']['retries'] == 0
+
+
+def test_download_sync_report_corrupted(get_extended_config, asset_server):
+    """test repeated transfer of corrupted asset is counted as retry"""
+    server, files, remote_dir = asset_server(small=1, large=0, delay=0)
+    dev_config = get_extended_config
+    dev_config.system.data['verify_retries'] = 2
+    dev_config.make_asset_paths()
+    _hash = hashlib.md5(b'expected content').hexdigest()
+
+    dev_config.get_files_async(list(dev_config.parse_files({_hash: list(files.values())[0]}).values()))
+
+    assert dev_config.download_report['transfers'][_hash]['retries'] == 2
+    assert dev_config.download_report['transfers'][_hash]['bytes'] == 3 * 2048
+
+
+@pytest.mark.parametrize('interval, expected', ((60, 2), (0, 6)))
+def test_download_sync_report_events(get_extended_config, asset_server, interval, expected):
+    """test sync progress is sent to event queue as INFO with limited rate, final report is always sent"""
+    server, files, remote_dir = asset_server(small=5, large=0, delay=0)
+    dev_config = get_extended_config
+    events = queue.Queue()
+    dev_config.system.data.update(sync_report=True, sync_report_interval=interval, q_int=events, max_workers=1)
+    dev_config.make_asset_paths()
+
+    dev_config.get_files_async(list(dev_config.parse_files(files).values()))
+    reports = [events.get_nowait() for _ in range(events.qsize())]
+
+    assert len(reports) == expected
+    assert all(event.type == 'device' and event.cmd == 'info' for event in reports)
+    final = reports[-1].data['sync_report']
+    assert final['final'] and not any(event.data['sync_report']['final'] for event in reports[:-1])
+    assert final['transferred'] == len(files)
+    assert final['failed'] == 0
@@ -0,0 +1,171 @@
+import logging
+import os
+import time
+
+import pytest
+import yaml
+
+from skabenclient.config import DeviceConfig, SystemConfig
+from skabenclient.device import BaseDevice
+from skabenclient.storage import JSONStorage, SQLiteStorage, YAMLStorage, backends, get_storage, msgpack, read_errors
+from skabenclient.tests.mock.data import make_assets, yaml_content_as_dict
+
+all_backends = [pytest.param(name, marks=pytest.mark.skipif(name == 'msgpack' and not msgpack,
+                                                               reason='msgpack is not installed'))
+                for name in backends]
+
+
+@pytest.fixture
+def yml_config(tmp_path):
+
+    def _wrap(data):
+        path = str(tmp_path / 'device.yml')
+        with open(path, 'w') as fh:
+            yaml.dump(data, fh)
+        return path
+
+    return _wrap
+
+
+@pytest.mark.parametrize('name', all_backends)
+def test_storage_round_trip(tmp_path, name):
+    """ Test storage writes and reads the same config """
+    storage = get_storage(name, str(tmp_path / 'device.yml'))
+    storage.write(yaml_content_as_dict)
+
+    assert storage.exists()
+    assert storage.read() == yaml_content_as_dict
+    assert os.path.splitext(storage.path)[1] == storage.extension
+
+
+@pytest.mark.parametrize('name', all_backends)
+def test_storage_tuples(tmp_path, name):
+    """ Test python/tuple values of yaml config keep their type in every storage """
+    data = {'pair': (1, 'a'), 'nested': {'points': [(0, 0), (1, (2, 3))]}, 'list': [1, 2],
+            'typed': {'__type__': 'tuple', 'items': [1]}}
+    storage = get_storage(name, str(tmp_path / 'device.yml'))
+    storage.write(data)
+
+    result = storage.read()
+    assert result == data
+    assert isinstance(result['pair'], tuple)
+    assert isinstance(result['nested']['points'][1][1], tuple)
+    assert isinstance(result['list'], list)
+
+
+@pytest.mark.parametrize('name', all_backends)
+def test_storage_empty(tmp_path, name):
+    """ Test empty storage is reported as read error """
+    storage = get_storage(name, str(tmp_path / 'device.yml'))
+    if storage.binary or name == 'sqlite':
+        open(storage.path, 'ab').close()
+    else:
+        open(storage.path, 'w').close()
+
+    with pytest.raises(read_errors):
+        storage.read()
+
+
+def test_storage_unknown(tmp_path):
+    with pytest.raises(Exception):
+        get_storage('ini', str(tmp_path / 'device.yml'))
+
+
+def test_storage_sqlite_partial_update(tmp_path):
+    """ Test sqlite storage updates and removes only given keys """
+    storage = SQLiteStorage(str(tmp_path / 'device.sqlite'))
+    storage.write({'one': 1, 'two': 2, 'gone': True})
+    storage.write({'one': 'changed', 'two': 'not saved'}, keys={'one', 'gone'})
+
+    assert storage.read() == {'one': 'changed', 'two': 2}
+
+
+@pytest.mark.parametrize('name', [backend for backend in all_backends if backend.values[0] != 'yaml'])
+def test_config_device_backend_migration_tuples(yml_config, name):
+    """ Test tuples of .yml config are migrated as tuples """
+    path = yml_config({'range': (1, 10)})
+    cfg = DeviceConfig(path, backend=name)
+
+    assert cfg.data == {'range': (1, 10)}
+    assert DeviceConfig(path, backend=name).get('range') == (1, 10)
+
+
+def test_config_device_backend_migration(yml_config):
+    """ Test existing .yml config is migrated to selected backend """
+    path = yml_config(yaml_content_as_dict)
+    cfg = DeviceConfig(path, backend='json')
+
+    assert isinstance(cfg.storage, JSONStorage)
+    assert cfg.data == yaml_content_as_dict, 'config not loaded after migration'
+    assert JSONStorage(cfg.storage.path).read() == yaml_content_as_dict, 'config not migrated'
+
+    cfg.save({'play': True})
+    assert YAMLStorage(path).read() == yaml_content_as_dict, 'original .yml should stay untouched'
+    assert DeviceConfig(path, backend='json').get('play') is True
+
+
+def test_config_device_backend_corrupted(yml_config, monkeypatch):
+    """ Test corrupted json config is reset to defaults """
+    monkeypatch.setattr(DeviceConfig, 'minimal_essential_conf', {'test': 'conf'})
+    cfg = DeviceConfig(yml_config({'test': 'conf'}), backend='json')
+    with open(cfg.storage.path, 'w') as fh:
+        fh.write('{"broken": ')
+
+    assert cfg.read() == {'test': 'conf'}
+
+
+def test_config_device_backend_partial_save(yml_config, monkeypatch):
+    """ Test only changed keys are passed to storage on save """
+    cfg = DeviceConfig(yml_config(yaml_content_as_dict), backend='sqlite')
+    written = []
+    write = cfg.storage.write
+    monkeypatch.setattr(cfg.storage, 'write', lambda data, keys=None, mode='w': written.append(keys)
+                        or write(data, keys, mode))
+    cfg.save({'play': True})
+    cfg.save({'FORCE': True, 'play': False})
+    cfg.save()
+
+    assert written == [{'play'}, None, None]
+    assert cfg.storage.read().get('play') is False
+    assert 'sound_files' not in cfg.storage.read(), 'destructive update not written'
+
+
+def test_config_device_backend_from_system_config(get_config, default_config, yml_config):
+    """ Test storage backend selected by system config """
+    devcfg = DeviceConfig(yml_config(yaml_content_as_dict))
+    syscfg = get_config(SystemConfig, {**default_config('sys'), 'config_backend': 'sqlite'})
+    device = BaseDevice(syscfg, devcfg)
+
+    assert isinstance(device.config.storage, SQLiteStorage)
+    assert device.config.data == yaml_content_as_dict
+
+
+@pytest.mark.parametrize('name', all_backends)
+def test_storage_benchmark(yml_config, name):
+    """ Benchmark config backends on config with large assets map """
+    rounds = 20
+    cfg = DeviceConfig(yml_config({'slider': 0, 'assets': make_assets(2000)}), backend=name)
+
+    start = time.perf_counter()
+    cfg.save()
+    full_write = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        cfg.storage._read_cache = None
+        cfg.read()
+    read = (time.perf_counter() - start) / rounds
+
+    start = time.perf_counter()
+    for idx in range(rounds):
+        cfg.save({'slider': idx})
+    partial_write = (time.perf_counter() - start) / rounds
+
+    size = sum(os.path.getsize(os.path.join(os.path.dirname(cfg.storage.path), fname))
+               for fname in os.listdir(os.path.dirname(cfg.storage.path))
+               if fname.startswith(os.path.basename(cfg.storage.path)))
+    logging.info(f'{name}: full write {full_write * 1000:.2f}ms, read {read * 1000:.2f}ms, '
+                 f'single key save {partial_write * 1000:.2f}ms, size {size / 1024:.0f}KB')
+
+    assert cfg.read()['slider'] == rounds - 1
+    assert cfg.read()['assets'] == make_assets(2000)
@@ -0,0 +1,60 @@
+import hashlib
+import os
+
+import pytest
+
+from skabenclient.assets import AssetStore, hash_algorithm
+
+
+@pytest.mark.parametrize('digest, expected', (
+        (hashlib.md5(b'').hexdigest(), 'md5'),
+        (hashlib.sha1(b'').hexdigest(), 'sha1'),
+        (hashlib.sha256(b'').hexdigest().upper(), 'sha256'),
+        ('MqmVaQ7L', None),
+        ('z' * 32, None),
+        ('', None),
+))
+def test_hash_algorithm(digest, expected):
+    assert hash_algorithm(digest) == expected
+
+
+@pytest.fixture
+def stored(tmp_path):
+    store = AssetStore(str(tmp_path / '.store'))
+    content = os.urandom(1024)
+    digest = hashlib.sha256(content).hexdigest()
+    incoming = store.incoming(digest)
+    with open(incoming, 'wb') as fh:
+        fh.write(content)
+    store.add(incoming, digest)
+    return store, digest, content
+
+
+def test_asset_store_link(stored, tmp_path):
+    """ Test stored content is hardlinked to every asset path """
+    store, digest, content = stored
+    paths = [str(tmp_path / 'one.bin'), str(tmp_path / 'two.bin')]
+    for path in paths:
+        store.link(digest, path)
+        store.link(digest, path)  # existing link replaced
+
+    assert store.has(digest)
+    assert os.stat(store.path(digest)).st_nlink == 3
+    for path in paths:
+        assert os.path.samefile(path, store.path(digest))
+
+
+def test_asset_store_link_fallback(stored, tmp_path, monkeypatch):
+    """ Test content is copied when filesystem has no hardlinks """
+    store, digest, content = stored
+    path = str(tmp_path / 'one.bin')
+
+    def no_link(*args):
+        raise PermissionError('operation not permitted')
+
+    monkeypatch.setattr(os, 'link', no_link)
+    store.link(digest, path)
+
+    assert not os.path.samefile(path, store.path(digest))
+    with open(path, 'rb') as fh:
+        assert fh.read() == content
@@ -0,0 +1,91 @@
+import logging
+import time
+
+import pytest
+
+import skabenclient.packets as sp
+
+topic = 'ask/test'
+uid = '00ff00ff00ff'
+datahold = {'slider': 10, 'playing': True, 'name': 'трек "1"', 'levels': [0.5, None]}
+
+
+@pytest.fixture
+def factory():
+    return sp.PacketFactory(topic, uid)
+
+
+@pytest.mark.parametrize('timestamp', (0, None, 1600000000))
+@pytest.mark.parametrize('config_hash', (None, '', 'abcdef'))
+def test_factory_pong(factory, timestamp, config_hash):
+    packet = sp.PONG(topic=topic, uid=uid, timestamp=timestamp, config_hash=config_hash)
+    assert factory.pong(timestamp, config_hash) == packet.encode()
+
+
+@pytest.mark.parametrize('command', ('ack', 'nack'))
+@pytest.mark.parametrize('task_id', (None, '', '1234567890'))
+@pytest.mark.parametrize('config_hash', (None, 'abcdef'))
+def test_factory_confirm(factory, command, task_id, config_hash):
+    packet_class = getattr(sp, command.upper())
+    packet = packet_class(topic=topic, uid=uid, task_id=task_id, timestamp=100, config_hash=config_hash)
+    assert factory.confirm(command, task_id, 100, config_hash) == packet.encode()
+
+
+@pytest.mark.parametrize('command', ('info', 'sup'))
+@pytest.mark.parametrize('task_id', (None, '1234567890'))
+@pytest.mark.parametrize('data', (datahold, {}))
+def test_factory_datahold(factory, command, task_id, data):
+    packet_class = getattr(sp, command.upper())
+    packet = packet_class(topic=topic, uid=uid, datahold=data, task_id=task_id, timestamp=100)
+    assert factory.datahold(command, data, 100, task_id) == packet.encode()
+
+
+@pytest.mark.parametrize('task_id', (None, '1234567890'))
+@pytest.mark.parametrize('config_hash', (None, 'abcdef'))
+def test_factory_cup(factory, task_id, config_hash):
+    packet = sp.CUP(topic=topic, uid=uid, datahold={'request': 'all'}, task_id=task_id, timestamp=100,
+                    config_hash=config_hash)
+    assert factory.datahold('cup', {'request': 'all'}, 100, task_id, config_hash) == packet.encode()
+
+
+def test_factory_no_uid():
+    factory = sp.PacketFactory(topic)
+    assert factory.pong(1) == sp.PONG(topic=topic, uid=None, timestamp=1).encode()
+
+
+def test_packet_slots():
+    packet = sp.SUP(topic=topic, uid=uid, datahold=datahold, timestamp=1)
+    assert not hasattr(packet, '__dict__')
+    assert packet.command == sp.SUP.command == 'sup'
+    with pytest.raises(AttributeError):
+        packet.extra = True
+
+
+def test_packet_benchmark(factory):
+    """ Benchmark packet encoding, packet classes vs factory
+
+        templates are expected to win on fixed-shape packets only,
+        SUP time is dominated by json.dumps of datahold in both paths
+    """
+    rounds = 20000
+    fixed_shape = ('pong', 'ack')
+    cases = {
+        'pong': (lambda ts: sp.PONG(topic=topic, uid=uid, timestamp=ts, config_hash='abcdef').encode(),
+                 lambda ts: factory.pong(ts, 'abcdef')),
+        'ack': (lambda ts: sp.ACK(topic=topic, uid=uid, task_id='123', timestamp=ts, config_hash='abcdef').encode(),
+                lambda ts: factory.confirm('ack', '123', ts, 'abcdef')),
+        'sup': (lambda ts: sp.SUP(topic=topic, uid=uid, datahold=datahold, task_id='123', timestamp=ts).encode(),
+                lambda ts: factory.datahold('sup', datahold, ts, '123')),
+    }
+    for name, (packet, template) in cases.items():
+        results = []
+        for make in (packet, template):
+            start = time.perf_counter()
+            for ts in range(rounds):
+                make(ts)
+            results.append(rounds / (time.perf_counter() - start))
+        logging.info(f'{name}: packet {results[0]:.0f}/s, factory {results[1]:.0f}/s, x{results[1] / results[0]:.1f}')
+
+        assert packet(rounds) == template(rounds)
+        if name in fixed_shape:
+            assert results[1] > results[0], f'{name} factory is slower than packet class'
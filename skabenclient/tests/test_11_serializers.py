@@ -0,0 +1,135 @@
+import base64
+import json
+import logging
+import os
+import time
+
+import pytest
+
+import skabenclient.packets as sp
+from skabenclient.serializers import JSONCodec, codecs, compressors, decode, get_codec, is_msgpack, msgpack, orjson, zstandard
+from skabenclient.tests.mock.comms import MockMessage
+
+installed = {'json': True, 'orjson': orjson, 'msgpack': msgpack}
+all_codecs = [pytest.param(name, marks=pytest.mark.skipif(not installed[name], reason=f'{name} is not installed'))
+              for name in codecs]
+
+small_datahold = {'blocked': False, 'powered': True, 'slider': 3, 'message': 'доступ разрешен'}
+large_datahold = {'assets': {f'{idx:064x}': {'url': f'http://127.0.0.1/media/sound/file_{idx}.ogg',
+                                             'file_type': 'sound',
+                                             'loaded': bool(idx % 2),
+                                             'size': idx * 1024}
+                             for idx in range(500)},
+                  'levels': [idx / 7 for idx in range(200)]}
+
+
+@pytest.mark.parametrize('name', all_codecs)
+@pytest.mark.parametrize('data', (small_datahold, large_datahold, {}))
+def test_codec_round_trip(name, data):
+    codec = get_codec(name)
+    payload = {'timestamp': 1600000000, 'hash': 'abc', 'datahold': data, 'task_id': None}
+    encoded = codec.dumps(payload)
+
+    assert isinstance(encoded, bytes)
+    assert codec.loads(encoded) == payload
+    assert decode(encoded) == payload, 'codec not detected'
+    assert is_msgpack(encoded) is (name == 'msgpack')
+
+
+def test_codec_default():
+    assert isinstance(get_codec(None), JSONCodec)
+    with pytest.raises(Exception):
+        get_codec('xml')
+
+
+@pytest.mark.parametrize('name', all_codecs)
+def test_factory_codec(name):
+    factory = sp.PacketFactory('ask/test', 'uid', codec=name)
+    packet = sp.SUP(topic='ask/test', uid='uid', datahold=small_datahold, task_id='123', timestamp=5)
+
+    assert factory.datahold('sup', small_datahold, 5, '123') == packet.encode(factory.codec)
+    message = MockMessage(factory.datahold('sup', small_datahold, 5, '123'))
+    assert message.decoded == packet.payload
+
+    pong = MockMessage(factory.pong(5, 'abc')).decoded
+    if name == 'json':
+        assert pong == {'timestamp': 5, 'hash': 'abc'}
+    else:
+        assert pong == {'timestamp': 5, 'hash': 'abc', 'codec': name}, 'codec not advertised'
+
+
+@pytest.mark.parametrize('name', all_codecs)
+def test_codec_benchmark(name):
+    """ Benchmark payload size and encode/decode speed on small and large dataholds """
+    codec = get_codec(name)
+    reference = len(json.dumps({'timestamp': 1, 'datahold': large_datahold}).encode('utf-8'))
+    for label, data, rounds in (('small', small_datahold, 20000), ('large', large_datahold, 50)):
+        payload = {'timestamp': 1600000000, 'datahold': data, 'task_id': '1234567890'}
+        start = time.perf_counter()
+        for _ in range(rounds):
+            encoded = codec.dumps(payload)
+        encode = (time.perf_counter() - start) / rounds
+        start = time.perf_counter()
+        for _ in range(rounds):
+            decode(encoded)
+        decoded = (time.perf_counter() - start) / rounds
+        logging.info(f'{name} {label}: {len(encoded)} bytes, encode {encode * 1e6:.1f}us, decode {decoded * 1e6:.1f}us')
+
+        assert decode(encoded) == payload
+    if name == 'msgpack':
+        assert len(encoded) < reference, 'msgpack payload is not smaller than json'
+
+
+installed_compressors = {'zlib': True, 'zstd': zstandard}
+all_compressors = [pytest.param(name, marks=pytest.mark.skipif(not installed_compressors[name],
+                                                               reason=f'{name} is not available'))
+                   for name in compressors]
+
+
+@pytest.mark.parametrize('compression', all_compressors)
+@pytest.mark.parametrize('name', all_codecs)
+def test_factory_compression(name, compression):
+    factory = sp.PacketFactory('ask/test', 'uid', codec=name, compression=compression, compress_threshold=1024)
+    topic, payload = factory.datahold('cup', large_datahold, 5, '123', 'abc')
+    plain = sp.PacketFactory('ask/test', 'uid', codec=name).datahold('cup', large_datahold, 5, '123', 'abc')
+
+    assert topic == plain[0]
+    assert len(payload) < len(plain[1])
+    assert get_codec(name).loads(payload)['compression'] == compression
+    assert decode(payload) == decode(plain[1]) == {'timestamp': 5, 'hash': 'abc', 'datahold': large_datahold,
+                                                   'task_id': '123'}
+
+
+@pytest.mark.parametrize('name', all_codecs)
+def test_factory_compression_skipped(name):
+    """ Test small and incompressible dataholds are sent as is """
+    factory = sp.PacketFactory('ask/test', 'uid', codec=name, compression='zlib', compress_threshold=1024)
+    plain = sp.PacketFactory('ask/test', 'uid', codec=name)
+    incompressible = {'noise': base64.b64encode(os.urandom(4096)).decode('ascii')}
+
+    assert factory.datahold('sup', small_datahold, 5) == plain.datahold('sup', small_datahold, 5)
+    _, payload = factory.datahold('sup', incompressible, 5)
+    assert len(payload) <= len(plain.datahold('sup', incompressible, 5)[1]), 'payload grown by compression'
+    assert decode(payload)['datahold'] == incompressible
+
+
+@pytest.mark.parametrize('compression', all_compressors)
+@pytest.mark.parametrize('name', all_codecs)
+def test_compression_benchmark(name, compression):
+    """ Benchmark compressed datahold size and encode/decode time """
+    rounds = 50
+    results = {}
+    for label, factory in (('plain', sp.PacketFactory('ask/test', 'uid', codec=name)),
+                           (compression, sp.PacketFactory('ask/test', 'uid', codec=name, compression=compression))):
+        start = time.perf_counter()
+        for ts in range(rounds):
+            _, payload = factory.datahold('sup', large_datahold, ts, '123')
+        encode = (time.perf_counter() - start) / rounds
+        start = time.perf_counter()
+        for _ in range(rounds):
+            decode(payload)
+        decoded = (time.perf_counter() - start) / rounds
+        results[label] = len(payload)
+        logging.info(f'{name} {label}: {len(payload)} bytes, encode {encode * 1e6:.0f}us, decode {decoded * 1e6:.0f}us')
+
+    assert results[compression] < results['plain'] / 2